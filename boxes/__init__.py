@@ -234,6 +234,27 @@ def argparseInts(s):
 
     return result
 
+def argparseMemorySize(s):
+    """
+    Parse a size in bytes with optional K, M or G suffix
+
+    :param s: string to parse, "0" or "none" for no limit (returns None)
+    """
+    s = s.strip().upper()
+    if s in ("", "0", "NONE"):
+        return None
+    factor = 1
+    if s[-1] in "KMG":
+        factor = 1024 ** ("KMG".index(s[-1]) + 1)
+        s = s[:-1]
+    try:
+        size = int(float(s) * factor)
+    except (ValueError, OverflowError):
+        raise argparse.ArgumentTypeError("Don't understand memory size")
+    if size <= 0:
+        raise argparse.ArgumentTypeError("Memory size must be positive or 0 for no limit")
+    return size
+
 class ArgparseEdgeType:
     """argparse type to select from a set of edge types"""
 
@@ -344,6 +365,8 @@ class Boxes:
 
     description: str = ""  # Markdown syntax is supported
 
+    _prototype: Boxes | None = None  # see fromPrototype(), set per class
+
     def __init__(self) -> None:
         self.formats = formats.Formats()
         self.ctx = None
@@ -356,6 +379,8 @@ class Boxes:
         self.edgesettings: dict[Any, Any] = {}
         self.non_default_args: dict[Any, Any] = {}
         self.translations = gettext.NullTranslations()
+        # Passed to the drawing surface. Use {"compact": True} to store paths in arrays
+        self.surface_options: dict[str, Any] = {}
 
         short_description: str = ""
         if self.__doc__:
@@ -420,6 +445,28 @@ class Boxes:
             "--debug", action="store", type=boolarg, default=False,
             help="print surrounding boxes for some structures [\U0001F6C8](https://florianfesti.github.io/boxes/html/usermanual.html#debug)")
 
+    @classmethod
+    def fromPrototype(cls):
+        """
+        Return a new instance without running __init__ again
+
+        The instance is copied from one created on first use and shares the
+        argument parser and Formats object with it and the other copies.
+        This is a lot cheaper for creating many instances, e.g. in the web
+        server. Do not change the argument parser of the returned instance.
+        """
+        prototype = cls.__dict__.get("_prototype")
+        if prototype is None:
+            prototype = cls()
+            cls._prototype = prototype
+        box = copy.copy(prototype)
+        # state changed by parseArgs()
+        box.edgesettings = {k: dict(v) for k, v in prototype.edgesettings.items()}
+        box.non_default_args = {}
+        box.metadata = dict(prototype.metadata, creation_date=datetime.datetime.now())
+        box.surface_options = {}
+        return box
+
     @contextmanager
     def saved_context(self):
         """
@@ -458,7 +505,7 @@ class Boxes:
             return
 
         self.bedBoltSettings = (3, 5.5, 2, 20, 15)  # d, d_nut, h_nut, l, l1
-        self.surface, self.ctx = self.formats.getSurface(self.format)
+        self.surface, self.ctx = self.formats.getSurface(self.format, **self.surface_options)
 
         if self.format == 'svg_Ponoko':
             self.ctx.set_line_width(0.01)
@@ -812,11 +859,13 @@ class Boxes:
         else:
             return param
 
-    def close(self):
+    def close(self, output=None):
         """Finish rendering
 
         Flush canvas to disk and convert output to requested format if needed.
-        Call after .render()"""
+        Call after .render()
+
+        :param output: binary stream, file descriptor or file name to write to instead of returning a BytesIO"""
         if self.ctx is None:
             return
 
@@ -826,10 +875,11 @@ class Boxes:
         self.surface.set_metadata(self.metadata)
 
         self.surface.flush()
-        data = self.surface.finish(self.inner_corners)
 
-        data = self.formats.convert(data, self.format)
-        return data
+        def write(stream):
+            return self.surface.finish(self.inner_corners, stream)
+
+        return self.formats.convert(write, self.format, output)
 
     ############################################################
     ### Turtle graphics commands
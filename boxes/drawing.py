@@ -1,11 +1,18 @@
 from __future__ import annotations
 
+import array
 import codecs
+import contextlib
 import io
 import math
+import os
+import threading
+import time
+import zlib
 from typing import Any
 from xml.etree import ElementTree as ET
 
+import numpy as np
 from affine import Affine
 
 from boxes.extents import Extents
@@ -16,23 +23,82 @@ PADDING = 10
 RANDOMIZE_COLORS = False  # enable to ease check for continuity of paths
 
 
-def reorder_attributes(root) -> None:
-    """
-    Source: https://docs.python.org/3/library/xml.etree.elementtree.html#xml.etree.ElementTree.Element.remove
+def escape_cdata(text):
+    """Escape character data like ElementTree does"""
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def escape_attrib(text):
+    """Escape attribute value like ElementTree does"""
+    return (escape_cdata(text).replace("\"", "&quot;").replace("\r", "&#13;")
+            .replace("\n", "&#10;").replace("\t", "&#09;"))
+
+
+def xml_start(tag, attrib):
+    """Start tag with attributes sorted by name"""
+    return "<" + tag + "".join(
+        f' {k}="{escape_attrib(v)}"' for k, v in sorted(attrib.items())) + ">"
+
+
+def xml_element(tag, attrib, text=""):
+    """Element without children serialized like ElementTree does"""
+    if text:
+        return f"{xml_start(tag, attrib)}{escape_cdata(text)}</{tag}>"
+    return xml_start(tag, attrib)[:-1] + " />"
+
+
+@contextlib.contextmanager
+def open_output(target):
+    """Binary stream to write to
+
+    :param target: None for a new BytesIO, a file descriptor, a file name or an open binary stream
+
+    Files are written under a temporary name and replace the file only
+    if writing succeeded.
     """
-    for el in root.iter():
-        attrib = el.attrib
-        if len(attrib) > 1:
-            # adjust attribute order, e.g. by sorting
-            attribs = sorted(attrib.items())
-            attrib.clear()
-            attrib.update(attribs)
+    if target is None:
+        yield io.BytesIO()
+    elif isinstance(target, int):
+        with os.fdopen(target, "wb", closefd=False) as f:
+            yield f
+    elif isinstance(target, (str, os.PathLike)):
+        if os.path.exists(target) and not os.path.isfile(target):
+            # e.g. /dev/stdout or a named pipe
+            with open(target, "wb") as f:
+                yield f
+            return
+        # the file a symlink points to, not the link
+        path = os.path.realpath(target)
+        # replace the file only when complete, so errors leave the old one
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                yield f
+            os.replace(tmp, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+            raise
+    else:
+        yield target
 
 
 def points_equal(x1, y1, x2, y2):
     return abs(x1 - x2) < EPS and abs(y1 - y2) < EPS
 
 
+def grid_cell(x, y):
+    """Grid cell containing (x, y), None for non finite points
+
+    Cells are 2*EPS wide so points_equal() points are in the same or
+    in neighbouring cells.
+    """
+    try:
+        return (math.floor(x / (2 * EPS)), math.floor(y / (2 * EPS)))
+    except (ValueError, OverflowError):
+        return None
+
+
 def pdiff(p1, p2):
     x1, y1 = p1
     x2, y2 = p2
@@ -44,10 +110,23 @@ class Surface:
     scale = 1.0
     invert_y = False
 
-    def __init__(self) -> None:
+    def __init__(self, compact=False, max_memory=None, max_time=None, max_cpu_time=None) -> None:
+        """
+        :param compact: store paths as CompactPath
+        :param max_memory: limit for the estimated size of the drawing in bytes, None for no limit
+        :param max_time: limit for the time spent drawing in seconds, None for no limit
+        :param max_cpu_time: limit for the CPU time of the drawing thread in seconds, None for no limit
+        """
         self.parts: list[Any] = []
+        self.compact = compact
+        self.max_memory = max_memory
+        self.max_time = max_time
+        self.max_cpu_time = max_cpu_time
         self._p = self.new_part("default")
         self.count = 0
+        self.memory = 0
+        self.start_time = time.monotonic()
+        self.start_cpu_time = time.thread_time()
 
     def set_metadata(self, metadata):
         self.metadata = metadata
@@ -83,44 +162,64 @@ class Surface:
         renderer.finish()
 
     def transform(self, f, m, invert_y=False):
-        for p in self.parts:
-            p.transform(f, m, invert_y)
+        for part in self.parts:
+            assert(not part.path)
+        pathes = [p for part in self.parts for p in part.pathes]
+        path_class = CompactPath if self.compact else Path
+        path_class.transform_all(pathes, f, m, invert_y)
 
     def new_part(self, name="part"):
         if self.parts and len(self.parts[-1].pathes) == 0:
             return self._p
-        p = Part(name)
+        p = Part(name, self.compact)
         self.parts.append(p)
         self._p = p
         return p
 
     def append(self, *path):
         self.count += 1
-        if self.count > 100000:
-            raise ValueError("Too many lines")
+        self.memory += self._p.path_class.command_size(path)
+        if self.max_memory is not None and self.memory > self.max_memory:
+            raise ValueError(f"Too many lines: drawing exceeds the limit of {self.max_memory} bytes")
+        if not self.count & 1023:
+            self.check_time()
         self._p.append(*path)
 
+    def check_time(self):
+        """Raise ValueError if drawing took longer than allowed"""
+        if self.max_time is not None and time.monotonic() - self.start_time > self.max_time:
+            raise ValueError(f"Drawing takes too long: exceeds the limit of {self.max_time} seconds")
+        if self.max_cpu_time is not None and time.thread_time() - self.start_cpu_time > self.max_cpu_time:
+            raise ValueError(f"Drawing takes too long: exceeds the limit of {self.max_cpu_time} seconds CPU time")
+
     def stroke(self, **params):
         return self._p.stroke(**params)
 
     def move_to(self, *xy):
+        self.count += 1
+        if not self.count & 1023:
+            self.check_time()
         self._p.move_to(*xy)
 
     def extents(self):
-        if not self.parts:
-            return Extents()
-        return sum([p.extents() for p in self.parts])
+        pathes = [p for part in self.parts for p in part.pathes]
+        path_class = CompactPath if self.compact else Path
+        return path_class.extents_all(pathes)
 
 
 class Part:
-    def __init__(self, name) -> None:
+    def __init__(self, name, compact=False) -> None:
         self.pathes: list[Any] = []
         self.path: list[Any] = []
+        self.path_class = CompactPath if compact else Path
+        # end points of self.pathes: grid_cell() -> [(index, path), ...]
+        self._ends: dict[Any, list[Any]] = {}
 
     def extents(self):
+        """Extents including the bulges of curves, e.g. for packing parts"""
         if not self.pathes:
             return Extents()
-        return sum([p.extents() for p in self.pathes])
+        return sum([p.extents(curves=True) for p in self.pathes])
 
     def transform(self, f, m, invert_y=False):
         assert(not self.path)
@@ -130,6 +229,27 @@ class Part:
     def append(self, *path):
         self.path.append(list(path))
 
+    def _index_end(self, idx, p):
+        cell = grid_cell(*p.end_point())
+        if cell is not None:
+            self._ends.setdefault(cell, []).append((idx, p))
+
+    def _find_end(self, x, y, params):
+        """Return index and path of the latest path ending at (x, y)"""
+        cell = grid_cell(x, y)
+        if cell is None:
+            return None
+        cx, cy = cell
+        found = None
+        # points within EPS may lie in neighbouring cells
+        for key in ((cx + dx, cy + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)):
+            for idx, p in self._ends.get(key, ()):
+                if found is not None and idx < found[0]:
+                    continue
+                if points_equal(x, y, *p.end_point()) and p.params == params:
+                    found = (idx, p)
+        return found
+
     def stroke(self, **params):
         if len(self.path) == 0:
             return
@@ -137,13 +257,17 @@ class Part:
         xy0 = self.path[0][1:3]
         if (not points_equal(*xy0, *self.path[-1][1:3]) and
             not self.path[0][0] == "T"):
-            for p in reversed(self.pathes):
-                xy1 = p.path[-1][1:3]
-                if points_equal(*xy0, *xy1) and p.params == params:
-                    p.path.extend(self.path[1:])
-                    self.path = []
-                    return p
-        p = Path(self.path, params)
+            found = self._find_end(*xy0, params)
+            if found is not None:
+                idx, p = found
+                cell = grid_cell(*p.end_point())
+                self._ends[cell].remove(found)
+                p.extend(self.path[1:])
+                self._index_end(idx, p)
+                self.path = []
+                return p
+        p = self.path_class(self.path, params)
+        self._index_end(len(self.pathes), p)
         self.pathes.append(p)
         self.path = []
         return p
@@ -172,26 +296,68 @@ class Path:
             return f"Path[{l}] to ({x2:.2f},{y2:.2f})"
         return f"empty Path"
 
-    def extents(self):
+    @staticmethod
+    def command_size(command):
+        """Rough estimate of the bytes needed to store command"""
+        # list with one pointer and one float object per item
+        return 32 * len(command) + 32
+
+    def end_point(self):
+        return self.path[-1][1:3]
+
+    def extend(self, commands):
+        self.path.extend(commands)
+
+    @staticmethod
+    def extents_all(pathes):
+        return sum([p.extents() for p in pathes], Extents())
+
+    def extents(self, curves=False):
+        """
+        :param curves: include the extrema of curves and not only their end points
+        """
         e = Extents()
+        beziers = []
+        x, y = 0.0, 0.0
         for p in self.path:
-            e.add(*p[1:3])
+            if p[0] == 'C' and curves:
+                beziers.append((x, y, *p[3:7], *p[1:3]))
+            x, y = p[1:3]
+            e.add(x, y)
             if p[0] == 'T':
-                m, text, params = p[3:]
-                h = params['fs']
-                l = len(text) * h * 0.7
-                align = params.get('align', 'left')
-                start, end = {
-                    'left' : (0, 1),
-                    'middle' : (-0.5, 0.5),
-                    'end' : (-1, 0),
-                    }[align]
-                for x in (start*l, end*l):
-                    for y in (0, h):
-                        x_, y_ = m * (x, y)
-                        e.add(x_, y_)
+                self._text_extents(e, *p[3:])
+        if beziers:
+            self._curve_extents(e, beziers)
         return e
 
+    @staticmethod
+    def _curve_extents(e, beziers):
+        xs, ys = curve_extrema(beziers, e.xmin, e.xmax, e.ymin, e.ymax)
+        for x in xs:
+            e.add(x, e.ymin)
+        for y in ys:
+            e.add(e.xmin, y)
+
+    @staticmethod
+    def _text_extents(e, m, text, params):
+        h = params['fs']
+        l = len(text) * h * 0.7
+        align = params.get('align', 'left')
+        start, end = {
+            'left' : (0, 1),
+            'middle' : (-0.5, 0.5),
+            'end' : (-1, 0),
+            }[align]
+        for x in (start*l, end*l):
+            for y in (0, h):
+                x_, y_ = m * (x, y)
+                e.add(x_, y_)
+
+    @staticmethod
+    def transform_all(pathes, f, m, invert_y=False):
+        for p in pathes:
+            p.transform(f, m, invert_y)
+
     def transform(self, f, m, invert_y=False):
         self.params["lw"] *= f
         for c in self.path:
@@ -209,26 +375,251 @@ class Path:
         if inner_corners == "backarc":
             return
 
-        for (i, p) in enumerate(self.path):
-            if p[0] == "C" and i > 1 and i < len(self.path) - 1:
-                if self.path[i - 1][0] == "L" and self.path[i + 1][0] == "L":
-                    p11 = self.path[i - 2][1:3]
-                    p12 = self.path[i - 1][1:3]
+        path = self.path
+        for (i, p) in enumerate(path):
+            if p[0] == "C" and i > 1 and i < len(path) - 1:
+                if path[i - 1][0] == "L" and path[i + 1][0] == "L":
+                    p11 = path[i - 2][1:3]
+                    p12 = path[i - 1][1:3]
                     p21 = p[1:3]
-                    p22 = self.path[i + 1][1:3]
+                    p22 = path[i + 1][1:3]
                     if (((p12[0]-p21[0])**2 + (p12[1]-p21[1])**2) >
                         self.params["lw"]**2):
                         continue
                     lines_intersect, x, y = line_intersection((p11, p12), (p21, p22))
                     if lines_intersect:
-                        self.path[i - 1] = ("L", x, y)
+                        path[i - 1] = ("L", x, y)
                         if inner_corners == "loop":
-                            self.path[i] = ("C", x, y, *p12, *p21)
+                            path[i] = ("C", x, y, *p12, *p21)
                         else:
-                            self.path[i] =  ("L", x, y)
+                            path[i] =  ("L", x, y)
         # filter duplicates
-        if len(self.path) > 1: # no need to find duplicates if only one element in path
-            self.path = [p for n, p in enumerate(self.path) if p != self.path[n-1]]
+        if len(path) > 1: # no need to find duplicates if only one element in path
+            path = [p for n, p in enumerate(path) if p != path[n-1]]
+        self.path = path
+
+
+# number of coordinates following each op code in CompactPath
+OP_SIZES = {"M": 2, "L": 2, "C": 6, "T": 2}
+_op_sizes = np.zeros(256, dtype=np.intp)
+_op_sizes[[ord(op) for op in OP_SIZES]] = list(OP_SIZES.values())
+
+
+class CompactPath(Path):
+    """Path storing its commands in flat arrays instead of nested lists
+
+    Op codes are kept in a bytearray and all coordinates as (x, y) pairs
+    in an array of doubles. The "T" commands keep their matrix, text and
+    params in a separate list. .path still returns the commands as lists
+    but is built on every access.
+    """
+
+    def __init__(self, path, params) -> None:
+        self.params = params
+        self.path = path
+
+    @property
+    def path(self):
+        coords = self.coords.tolist()
+        texts = iter(self.texts)
+        result = []
+        pos = 0
+        for op in self.ops.decode("ascii"):
+            n = OP_SIZES[op]
+            c = [op, *coords[pos:pos+n]]
+            if op == "T":
+                c.extend(next(texts))
+            result.append(c)
+            pos += n
+        return result
+
+    @path.setter
+    def path(self, path):
+        self.ops = bytearray()
+        self.coords = array.array("d")
+        self.texts = []
+        self._last = 0
+        self.extend(path)
+
+    def __repr__(self) -> str:
+        l = len(self.ops)
+        if l>0:
+            x2, y2 = self.end_point()
+            return f"CompactPath[{l}] to ({x2:.2f},{y2:.2f})"
+        return f"empty CompactPath"
+
+    @staticmethod
+    def command_size(command):
+        # op code and one double per coordinate, ignoring the text payload
+        return 1 + 8 * OP_SIZES.get(command[0], 0)
+
+    def end_point(self):
+        return self.coords[self._last], self.coords[self._last+1]
+
+    def extend(self, commands):
+        for c in commands:
+            C = c[0]
+            n = OP_SIZES[C]
+            self._last = len(self.coords)
+            self.ops.append(ord(C))
+            self.coords.extend(c[1:n+1])
+            if C == "T":
+                self.texts.append(list(c[3:]))
+
+    @staticmethod
+    def _extents(ops, coords, texts, curves=False):
+        if not len(ops):
+            return Extents()
+        # index of the first coordinate of every command
+        sizes = _op_sizes[ops]
+        starts = np.cumsum(sizes) - sizes
+        xs = coords[starts]
+        ys = coords[starts + 1]
+        e = Extents(float(xs.min()), float(ys.min()),
+                    float(xs.max()), float(ys.max()))
+        if curves:
+            # curves start at the end point of the command before
+            c = np.flatnonzero(ops == ord("C"))
+            c = c[c > 0]
+            if len(c):
+                s = starts[c]
+                p = starts[c - 1]
+                beziers = np.stack((coords[p], coords[p + 1], coords[s + 2], coords[s + 3],
+                                    coords[s + 4], coords[s + 5], coords[s], coords[s + 1]), axis=1)
+                CompactPath._curve_extents(e, beziers)
+        for t in texts:
+            CompactPath._text_extents(e, *t)
+        return e
+
+    @staticmethod
+    def extents_all(pathes):
+        """Extents of all pathes in one pass"""
+        if not pathes:
+            return Extents()
+        return CompactPath._extents(
+            np.frombuffer(b"".join(p.ops for p in pathes), dtype=np.uint8),
+            np.concatenate([np.frombuffer(p.coords) for p in pathes]),
+            (t for p in pathes for t in p.texts))
+
+    def extents(self, curves=False):
+        return self._extents(np.frombuffer(self.ops, dtype=np.uint8),
+                             np.frombuffer(self.coords), self.texts, curves)
+
+    @staticmethod
+    def transform_all(pathes, f, m, invert_y=False):
+        """Transform the coordinates of all pathes in one pass"""
+        if not pathes:
+            return
+        coords = np.concatenate([np.frombuffer(p.coords) for p in pathes])
+        transform_coords(coords, m)
+        pos = 0
+        for p in pathes:
+            n = len(p.coords)
+            np.frombuffer(p.coords)[:] = coords[pos:pos+n]
+            pos += n
+            p._transform_params(f, m, invert_y)
+
+    def transform(self, f, m, invert_y=False):
+        transform_coords(np.frombuffer(self.coords), m)
+        self._transform_params(f, m, invert_y)
+
+    def _transform_params(self, f, m, invert_y):
+        self.params["lw"] *= f
+        for t in self.texts:
+            t[0] = m * t[0]
+            if invert_y:
+                t[0] *= Affine.scale(1, -1)
+
+
+def transform_coords(coords, m):
+    """Apply Affine m in place to a flat numpy array of x, y pairs"""
+    xy = coords.reshape(-1, 2)
+    x = xy[:, 0].copy()
+    y = xy[:, 1].copy()
+    sa, sb, sc, sd, se, sf = m[:6]
+    # same order of operations as Affine.__mul__ to get identical results
+    xy[:, 0] = x * sa + y * sb + sc
+    xy[:, 1] = x * sd + y * se + sf
+
+
+def flatten_curve(x0, y0, x1, y1, x2, y2, x3, y3, flatness):
+    """Points of a cubic Bezier curve approximated by straight lines
+
+    :param flatness: max distance of the lines from the curve
+    :return: list of points without the start point
+    """
+    dd = max(math.hypot(x0 - 2*x1 + x2, y0 - 2*y1 + y2),
+             math.hypot(x1 - 2*x2 + x3, y1 - 2*y2 + y3))
+    n = max(1, math.ceil(math.sqrt(0.75 * dd / flatness)))
+    points = []
+    for i in range(1, n + 1):
+        t = i / n
+        s = 1 - t
+        a, b, c, d = s*s*s, 3*s*s*t, 3*s*t*t, t*t*t
+        points.append((a*x0 + b*x1 + c*x2 + d*x3,
+                       a*y0 + b*y1 + c*y2 + d*y3))
+    return points
+
+
+def cubic_extrema(p0, p1, p2, p3):
+    """Coordinates of the extrema inside of cubic Bézier curves along one axis
+
+    Takes arrays with one coordinate of the points of all curves.
+    """
+    # roots of the derivative a t² + b t + c
+    a = p3 - 3 * p2 + 3 * p1 - p0
+    b = 2 * (p2 - 2 * p1 + p0)
+    c = p1 - p0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        root = np.sqrt(b * b - 4 * a * c)
+        linear = np.abs(a) < 1e-12
+        t = np.concatenate((np.where(linear, -c / b, (-b + root) / (2 * a)),
+                            np.where(linear, np.nan, (-b - root) / (2 * a))))
+    # not a number if there is no root
+    inside = (t > 0) & (t < 1)
+    t = t[inside]
+    p0, p1, p2, p3 = (np.concatenate((p, p))[inside] for p in (p0, p1, p2, p3))
+    u = 1 - t
+    return u**3 * p0 + 3 * u * u * t * p1 + 3 * u * t * t * p2 + t**3 * p3
+
+
+def curve_extrema(curves, xmin, xmax, ymin, ymax):
+    """x and y coordinates of the curves extending beyond the given box
+
+    Takes the curves as (x0, y0, x1, y1, x2, y2, x3, y3) each.
+    """
+    c = np.asarray(curves, dtype=float).reshape(-1, 8).T
+    # curves stay within the hull of their control points
+    inside = ((xmin <= c[2]) & (c[2] <= xmax) & (xmin <= c[4]) & (c[4] <= xmax) &
+              (ymin <= c[3]) & (c[3] <= ymax) & (ymin <= c[5]) & (c[5] <= ymax))
+    c = c[:, ~inside]
+    if not c.shape[1]:
+        return [], []
+    return (cubic_extrema(c[0], c[2], c[4], c[6]).tolist(),
+            cubic_extrema(c[1], c[3], c[5], c[7]).tolist())
+
+
+def nearest_neighbour_order(starts, ends, x=0.0, y=0.0):
+    """Order in which to visit lines to keep the moves between them short
+
+    Greedily goes to the closest start point from the end of the last line.
+
+    :param starts: list of start points
+    :param ends: list of end points
+    :param x: x of the starting position
+    :param y: y of the starting position
+    :return: list of indices
+    """
+    sx = np.array([p[0] for p in starts], dtype=float)
+    sy = np.array([p[1] for p in starts], dtype=float)
+    order = []
+    for _ in range(len(starts)):
+        i = int(np.argmin((sx - x)**2 + (sy - y)**2))
+        order.append(i)
+        sx[i] = sy[i] = np.inf
+        x, y = ends[i]
+    return order
+
 
 class Context:
     def __init__(self, surface, *al, **ad) -> None:
@@ -415,42 +806,54 @@ class SVGSurface(Surface):
         'monospaced' : '"Courier New", Courier, "Lucida Sans Typewriter"'
     }
 
-    def _addTag(self, parent, tag, text, first=False):
-        if first:
-            t = ET.Element(tag)
-        else:
-            t = ET.SubElement(parent, tag)
-        t.text = text
-        t.tail = '\n'
-        if first:
-            parent.insert(0, t)
-        return t
-
-    def _add_metadata(self, root) -> None:
+    nsmap = {
+        "dc": "http://purl.org/dc/elements/1.1/",
+        "cc": "http://creativecommons.org/ns#",
+        "rdf": "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
+        "svg": "http://www.w3.org/2000/svg",
+        "xlink": "http://www.w3.org/1999/xlink",
+        "inkscape": "http://www.inkscape.org/namespaces/inkscape",
+    }
+
+    part_style = "fill:none;stroke-linecap:round;stroke-linejoin:round;"
+
+    def _write_metadata(self, f) -> None:
         md = self.metadata
 
         title = "{group} - {name}".format(**md)
         creation_date: str = md["creation_date"].strftime("%Y-%m-%d %H:%M:%S")
 
-        # Add Inkscape style rdf meta data
-        root.set("xmlns:dc", "http://purl.org/dc/elements/1.1/")
-        root.set("xmlns:cc", "http://creativecommons.org/ns#")
-        root.set("xmlns:rdf", "http://www.w3.org/1999/02/22-rdf-syntax-ns#")
+        # XML comment
+        txt = """\n{name} - {short_description}\n""".format(**md)
+        if md["description"]:
+            txt += """\n\n{description}\n\n""".format(**md)
+        txt += """\nCreated with Boxes.py (https://boxes.hackerspace-bamberg.de/)\n"""
+        if not md["reproducible"]:
+            txt += f"""Creation date: {creation_date}\n"""
+
+        txt += "Command line (remove spaces between dashes): %s\n" % md["cli_short"]
 
-        m = self._addTag(root, "metadata", '\n', True)
-        r = ET.SubElement(m, 'rdf:RDF')
-        w = ET.SubElement(r, 'cc:Work')
-        w.text = '\n'
+        if md["url"]:
+            txt += "Url: %s\n" % md["url"]
+            txt += "Url short: %s\n" % md["url_short"]
+            txt += "SettingsUrl: %s\n" % md["url"].replace("&render=1", "")
+            txt += "SettingsUrl short: %s\n" % md["url_short"].replace("&render=1", "")
+        f.write("<!--%s-->\n" % txt.replace("--", "- -").replace("--", "- -")) # ----
 
-        self._addTag(w, 'dc:title', title)
+        # title
+        f.write(xml_element("title", {}, md["name"]) + "\n")
+
+        # Inkscape style rdf meta data
+        f.write("<metadata>\n<rdf:RDF><cc:Work>\n")
+        f.write(xml_element("dc:title", {}, title) + "\n")
         if not md["reproducible"]:
-            self._addTag(w, 'dc:date', creation_date)
+            f.write(xml_element("dc:date", {}, creation_date) + "\n")
 
         if md.get("url"):
-            self._addTag(w, 'dc:source', md["url"])
-            self._addTag(w, 'dc:source', md["url_short"])
+            f.write(xml_element("dc:source", {}, md["url"]) + "\n")
+            f.write(xml_element("dc:source", {}, md["url_short"]) + "\n")
         else:
-            self._addTag(w, 'dc:source', md["cli"])
+            f.write(xml_element("dc:source", {}, md["cli"]) + "\n")
 
         desc = md["short_description"] or ""
         if md.get("description"):
@@ -463,133 +866,137 @@ class SVGSurface(Surface):
             desc += "Url short: %s\n" % md["url_short"]
             desc += "SettingsUrl: %s\n" % md["url"].replace("&render=1", "")
             desc += "SettingsUrl short: %s\n" % md["url_short"].replace("&render=1", "")
-        self._addTag(w, 'dc:description', desc)
-
-        # title
-        self._addTag(root, "title", md["name"], True)
-
-        # Add XML comment
-        txt = """\n{name} - {short_description}\n""".format(**md)
-        if md["description"]:
-            txt += """\n\n{description}\n\n""".format(**md)
-        txt += """\nCreated with Boxes.py (https://boxes.hackerspace-bamberg.de/)\n"""
-        if not md["reproducible"]:
-            txt += f"""Creation date: {creation_date}\n"""
-
-        txt += "Command line (remove spaces between dashes): %s\n" % md["cli_short"]
-
-        if md["url"]:
-            txt += "Url: %s\n" % md["url"]
-            txt += "Url short: %s\n" % md["url_short"]
-            txt += "SettingsUrl: %s\n" % md["url"].replace("&render=1", "")
-            txt += "SettingsUrl short: %s\n" % md["url_short"].replace("&render=1", "")
-        m = ET.Comment(txt.replace("--", "- -").replace("--", "- -")) # ----
-        m.tail = '\n'
-        root.insert(0, m)
+        f.write(xml_element("dc:description", {}, desc) + "\n")
+        f.write("</cc:Work></rdf:RDF></metadata>\n")
+
+    def _part_elements(self, part, inner_corners="loop"):
+        """(tag, attributes, text) of the SVG elements of a part
+
+        :param inner_corners: passed to Path.faster_edges(), None if already done
+        """
+        for path in part.pathes:
+            p = []
+            x, y = 0, 0
+            start = None
+            last = None
+            if inner_corners is not None:
+                path.faster_edges(inner_corners)
+            for c in path.path:
+                x0, y0 = x, y
+                C, x, y = c[0:3]
+                if C == "M":
+                    if start and points_equal(start[1], start[2],
+                                              last[1], last[2]):
+                        p.append("Z")
+                    start = c
+                    p.append(f"M {x:.3f} {y:.3f}")
+                elif C == "L":
+                    if abs(x - x0) < EPS:
+                        p.append(f"V {y:.3f}")
+                    elif abs(y - y0) < EPS:
+                        p.append(f"H {x:.3f}")
+                    else:
+                        p.append(f"L {x:.3f} {y:.3f}")
+                elif C == "C":
+                    x1, y1, x2, y2 = c[3:]
+                    p.append(
+                        f"C {x1:.3f} {y1:.3f} {x2:.3f} {y2:.3f} {x:.3f} {y:.3f}"
+                    )
+                elif C == "T":
+                    m, text, params = c[3:]
+                    m = m * Affine.translation(0, -params['fs'])
+                    tm = " ".join(f"{m[i]:.3f}" for i in (0, 3, 1, 4, 2, 5))
+                    font, bold, italic = params['ff']
+                    fontweight = ("normal", "bold")[bool(bold)]
+                    fontstyle = ("normal", "italic")[bool(italic)]
+
+                    style = f"font-family: {font} ; font-weight: {fontweight}; font-style: {fontstyle}; fill: {rgb_to_svg_color(*params['rgb'])}"
+                    yield "text", {
+                        #"x": f"{x:.3f}", "y": f"{y:.3f}",
+                        "transform": f"matrix( {tm} )",
+                        "style": style,
+                        "font-size": f"{params['fs']}px",
+                        "text-anchor": params.get('align', 'left'),
+                        "dominant-baseline": 'hanging'}, text
+                else:
+                    print("Unknown", c)
+
+                last = c
+
+            if start and start is not last and \
+               points_equal(start[1], start[2], last[1], last[2]):
+                p.append("Z")
+            color = (
+                random_svg_color()
+                if RANDOMIZE_COLORS
+                else rgb_to_svg_color(*path.params["rgb"])
+            )
+            if p and p[-1][0] == "M":
+                p.pop()
+            if p:  # might be empty if only contains text
+                yield "path", {
+                    "d": " ".join(p), "stroke": color,
+                    "stroke-width": f'{path.params["lw"]:.2f}'}, ""
+
+    def part_groups(self):
+        """Parts as ElementTree groups together with their extents
+
+        Call after finish() to hand the parts to the packer of
+        boxes.svgmerge without parsing the SVG. The groups contain the
+        same elements as written and the extents are in SVG coordinates.
+        """
+        groups = []
+        for i, part in enumerate(self.parts):
+            if not part.pathes:
+                continue
+            g = ET.Element(f"{{{self.nsmap['svg']}}}g", {"id": f"p-{i}", "style": self.part_style})
+            for tag, attrib, text in self._part_elements(part, None):
+                ET.SubElement(g, f"{{{self.nsmap['svg']}}}{tag}", attrib).text = text or None
+            groups.append((g, part.extents()))
+        return groups
+
+    def finish(self, inner_corners="loop", stream=None):
+        """Write the SVG document
+
+        :param stream: binary file like object, file descriptor or file name to write to, a new BytesIO if None
+        """
+        if isinstance(stream, (int, str, os.PathLike)):
+            with open_output(stream) as f:
+                self.finish(inner_corners, f)
+            return stream
 
-    def finish(self, inner_corners="loop"):
         extents = self._adjust_coordinates()
         w = extents.width * self.scale
         h = extents.height * self.scale
 
+        data = io.BytesIO() if stream is None else stream
+        # same output as ElementTree: sorted attributes, utf-8 with char refs as fallback
+        f = codecs.getwriter('utf-8')(data, errors="xmlcharrefreplace")
+        f.write("<?xml version='1.0' encoding='utf-8'?>\n")
+        attrib = {"width": f"{w:.2f}mm", "height": f"{h:.2f}mm",
+                  "viewBox": f"0.0 0.0 {w:.2f} {h:.2f}",
+                  "xmlns": "http://www.w3.org/2000/svg"}
+        for name, value in self.nsmap.items():
+            attrib[f"xmlns:{name}"] = value
+        f.write(xml_start("svg", attrib) + "\n")
 
-        nsmap = {
-                "dc": "http://purl.org/dc/elements/1.1/",
-                "cc": "http://creativecommons.org/ns#",
-                "rdf": "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
-                "svg": "http://www.w3.org/2000/svg",
-                "xlink": "http://www.w3.org/1999/xlink",
-                "inkscape": "http://www.inkscape.org/namespaces/inkscape",
-            }
-        ET.register_namespace("", "http://www.w3.org/2000/svg")
-        ET.register_namespace("xlink", "http://www.w3.org/1999/xlink")
-        svg = ET.Element('svg', width=f"{w:.2f}mm", height=f"{h:.2f}mm",
-                         viewBox=f"0.0 0.0 {w:.2f} {h:.2f}",
-                         xmlns="http://www.w3.org/2000/svg")
-        for name, value in nsmap.items():
-            svg.set(f"xmlns:{name}", value)
-        svg.text = "\n"
-        tree = ET.ElementTree(svg)
-
-        self._add_metadata(svg)
+        self._write_metadata(f)
 
         for i, part in enumerate(self.parts):
             if not part.pathes:
                 continue
-            g = ET.SubElement(svg, "g", id=f"p-{i}",
-                              style="fill:none;stroke-linecap:round;stroke-linejoin:round;")
-            g.text = "\n  "
-            g.tail = "\n"
-            for j, path in enumerate(part.pathes):
-                p = []
-                x, y = 0, 0
-                start = None
-                last = None
-                path.faster_edges(inner_corners)
-                for c in path.path:
-                    x0, y0 = x, y
-                    C, x, y = c[0:3]
-                    if C == "M":
-                        if start and points_equal(start[1], start[2],
-                                                  last[1], last[2]):
-                            p.append("Z")
-                        start = c
-                        p.append(f"M {x:.3f} {y:.3f}")
-                    elif C == "L":
-                        if abs(x - x0) < EPS:
-                            p.append(f"V {y:.3f}")
-                        elif abs(y - y0) < EPS:
-                            p.append(f"H {x:.3f}")
-                        else:
-                            p.append(f"L {x:.3f} {y:.3f}")
-                    elif C == "C":
-                        x1, y1, x2, y2 = c[3:]
-                        p.append(
-                            f"C {x1:.3f} {y1:.3f} {x2:.3f} {y2:.3f} {x:.3f} {y:.3f}"
-                        )
-                    elif C == "T":
-                        m, text, params = c[3:]
-                        m = m * Affine.translation(0, -params['fs'])
-                        tm = " ".join(f"{m[i]:.3f}" for i in (0, 3, 1, 4, 2, 5))
-                        font, bold, italic = params['ff']
-                        fontweight = ("normal", "bold")[bool(bold)]
-                        fontstyle = ("normal", "italic")[bool(italic)]
-
-                        style = f"font-family: {font} ; font-weight: {fontweight}; font-style: {fontstyle}; fill: {rgb_to_svg_color(*params['rgb'])}"
-                        t = ET.SubElement(g, "text",
-                                          #x=f"{x:.3f}", y=f"{y:.3f}",
-                                          transform=f"matrix( {tm} )",
-                                          style=style)
-                        t.text = text
-                        t.set("font-size", f"{params['fs']}px")
-                        t.set("text-anchor", params.get('align', 'left'))
-                        t.set("dominant-baseline", 'hanging')
-                        t.tail = "\n  "
-                    else:
-                        print("Unknown", c)
-
-                    last = c
-
-                if start and start is not last and \
-                   points_equal(start[1], start[2], last[1], last[2]):
-                    p.append("Z")
-                color = (
-                    random_svg_color()
-                    if RANDOMIZE_COLORS
-                    else rgb_to_svg_color(*path.params["rgb"])
-                )
-                if p and p[-1][0] == "M":
-                    p.pop()
-                if p:  # might be empty if only contains text
-                    t = ET.SubElement(g, "path", d=" ".join(p), stroke=color)
-                    t.set("stroke-width", f'{path.params["lw"]:.2f}')
-                    t.tail = "\n  "
-            t.tail = "\n"
-        reorder_attributes(tree)
-        f = io.BytesIO()
-        tree.write(f, encoding="utf-8", xml_declaration=True, method="xml")
-        f.seek(0)
-        return f
+            f.write(xml_start("g", {"id": f"p-{i}", "style": self.part_style}))
+            # every child is preceded by "\n  ", the last one followed by "\n"
+            children = 0
+            for tag, attrib, text in self._part_elements(part, inner_corners):
+                f.write("\n  ")
+                children += 1
+                f.write(xml_element(tag, attrib, text))
+            f.write("\n</g>\n" if children else "\n  </g>\n")
+        f.write("</svg>")
+        if stream is None:
+            data.seek(0)
+        return data
 
 class PSSurface(Surface):
 
@@ -638,13 +1045,21 @@ class PSSurface(Surface):
             desc += f'%%SettingsUrl short: {md["url_short"].replace("&render=1", "")}\n'
         return desc
 
-    def finish(self, inner_corners="loop"):
+    def finish(self, inner_corners="loop", stream=None):
+        """Write the EPS document
+
+        :param stream: binary file like object, file descriptor or file name to write to, a new BytesIO if None
+        """
+        if isinstance(stream, (int, str, os.PathLike)):
+            with open_output(stream) as f:
+                self.finish(inner_corners, f)
+            return stream
 
         extents = self._adjust_coordinates()
         w = extents.width
         h = extents.height
 
-        data = io.BytesIO()
+        data = io.BytesIO() if stream is None else stream
         f = codecs.getwriter('utf-8')(data)
 
         f.write(f"""%!PS-Adobe-2.0 EPSF-2.0
@@ -745,7 +1160,186 @@ showpage
 %%EOF
 """
         )
-        data.seek(0)
+        if stream is None:
+            data.seek(0)
+        return data
+
+class PDFSurface(Surface):
+    """Single page PDF with zlib compressed content using the base 14 fonts"""
+
+    scale = 72 / 25.4 # 72 dpi
+
+    fonts = PSSurface.fonts
+
+    # advance widths of the characters " " to "~" in 1/1000 of the font size
+    # from the Adobe font metrics. Oblique and italic variants use the upright
+    # widths, good enough for aligning text
+    widths = {
+        "Helvetica": [
+            278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+            556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+            1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+            667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+            333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+            556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584],
+        "Helvetica-Bold": [
+            278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333, 278, 278,
+            556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333, 584, 584, 584, 611,
+            975, 722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833, 722, 778,
+            667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 333, 278, 333, 584, 556,
+            333, 556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889, 611, 611,
+            611, 611, 389, 556, 333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584],
+        "Times-Roman": [
+            250, 333, 408, 500, 500, 833, 778, 180, 333, 333, 500, 564, 250, 333, 250, 278,
+            500, 500, 500, 500, 500, 500, 500, 500, 500, 500, 278, 278, 564, 564, 564, 444,
+            921, 722, 667, 667, 722, 611, 556, 722, 722, 333, 389, 722, 611, 889, 722, 722,
+            556, 722, 667, 556, 611, 722, 722, 944, 722, 722, 611, 333, 278, 333, 469, 500,
+            333, 444, 500, 444, 500, 444, 333, 500, 500, 278, 278, 500, 278, 778, 500, 500,
+            500, 500, 333, 389, 278, 500, 500, 722, 500, 500, 444, 480, 200, 480, 541],
+        "Times-Bold": [
+            250, 333, 555, 500, 500, 1000, 833, 278, 333, 333, 500, 570, 250, 333, 250, 278,
+            500, 500, 500, 500, 500, 500, 500, 500, 500, 500, 333, 333, 570, 570, 570, 500,
+            930, 722, 667, 722, 722, 667, 611, 778, 778, 389, 500, 778, 667, 944, 722, 778,
+            611, 778, 722, 556, 667, 722, 722, 1000, 722, 722, 667, 333, 278, 333, 581, 500,
+            333, 500, 556, 444, 556, 444, 333, 500, 556, 278, 333, 556, 278, 833, 556, 500,
+            556, 556, 444, 389, 333, 556, 500, 722, 500, 500, 444, 394, 220, 394, 520],
+        "Courier": [600] * 95,
+    }
+
+    # lower end of the font bounding box, text is moved up by it like in PSSurface
+    descent = {"Helvetica": 225, "Times": 218, "Courier": 250}
+
+    @staticmethod
+    def _string(s):
+        """PDF text string, UTF-16 if it is not plain ASCII"""
+        if s.isascii():
+            return "(" + s.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ")"
+        return "<" + codecs.BOM_UTF16_BE.hex() + s.encode("utf-16-be").hex() + ">"
+
+    def _text_width(self, font, text):
+        base = font.split("-")[0]
+        if font.endswith(("Bold", "BoldOblique", "BoldItalic")):
+            widths = self.widths.get(base + "-Bold", self.widths["Courier"])
+        else:
+            widths = self.widths.get(base + ("-Roman" if base == "Times" else ""),
+                                     self.widths["Courier"])
+        # non ASCII characters are counted with the width of "n"
+        return sum(widths[ord(c) - 32] if 31 < ord(c) < 127 else widths[78]
+                   for c in text)
+
+    def _info(self):
+        md = self.metadata
+        info = {
+            "Title": "Boxes.py - {group} - {name}".format(**md),
+            "Subject": md["short_description"] or "",
+            "Keywords": "boxes.py, laser, laser cutter",
+            "Creator": md.get("url") or md["cli"],
+            "Producer": "Boxes.py (https://boxes.hackerspace-bamberg.de/)",
+        }
+        if not md["reproducible"]:
+            info["CreationDate"] = md["creation_date"].strftime("D:%Y%m%d%H%M%S")
+        return "<<" + "".join(f" /{k} {self._string(v)}" for k, v in info.items()) + " >>"
+
+    def finish(self, inner_corners="loop", stream=None):
+        """Write the PDF document
+
+        :param stream: binary file like object, file descriptor or file name to write to, a new BytesIO if None
+        """
+        if isinstance(stream, (int, str, os.PathLike)):
+            with open_output(stream) as f:
+                self.finish(inner_corners, f)
+            return stream
+
+        extents = self._adjust_coordinates()
+        w = extents.width
+        h = extents.height
+
+        data = io.BytesIO() if stream is None else stream
+        # byte offsets of the objects for the cross reference table
+        offsets = {}
+        pos = 0
+
+        def write(b):
+            nonlocal pos
+            data.write(b)
+            pos += len(b)
+
+        def write_object(num, body):
+            offsets[num] = pos
+            write(f"{num} 0 obj\n{body}\nendobj\n".encode("latin-1"))
+
+        # objects 1-5 are catalog, pages, page, content and content length
+        write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        offsets[4] = pos
+        write(b"4 0 obj\n<< /Length 5 0 R /Filter /FlateDecode >>\nstream\n")
+        start = pos
+        # the content is compressed and written path by path
+        compressor = zlib.compressobj()
+        fonts = {}
+        write(compressor.compress(b"1 J 1 j\n"))
+        for part in self.parts:
+            for path in part.pathes:
+                p = []
+                path.faster_edges(inner_corners)
+                for c in path.path:
+                    C, x, y = c[0:3]
+                    if C == "M":
+                        p.append(f"{x:.3f} {y:.3f} m")
+                    elif C == "L":
+                        p.append(f"{x:.3f} {y:.3f} l")
+                    elif C == "C":
+                        x1, y1, x2, y2 = c[3:]
+                        p.append(f"{x1:.3f} {y1:.3f} {x2:.3f} {y2:.3f} {x:.3f} {y:.3f} c")
+                    elif C == "T":
+                        m, text, params = c[3:]
+                        font = self.fonts[params['ff']]
+                        name = fonts.setdefault(font, f"F{len(fonts) + 1}")
+                        tm = " ".join(f"{m[i]:.3f}" for i in (0, 3, 1, 4, 2, 5))
+                        color = " ".join(f"{c:.2f}" for c in params["rgb"])
+                        align = params.get('align', 'left')
+                        fs = params['fs']
+                        dx = 0.0
+                        if align != "left":
+                            dx = -self._text_width(font, text) * fs / 1000
+                            if align == "middle":
+                                dx *= 0.5
+                        dy = self.descent[font.split("-")[0]] * fs / 1000
+                        raw = text.encode("cp1252", errors="replace")
+                        raw = raw.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+                        # text objects must not be inside a path, write them right away
+                        write(compressor.compress(
+                            f"BT /{name} {fs} Tf {color} rg {tm} Tm {dx:.3f} {dy:.3f} Td (".encode("latin-1") +
+                            raw + b") Tj ET\n"))
+                    else:
+                        print("Unknown", c)
+                if p:
+                    color = " ".join(f"{c:.2f}" for c in path.params["rgb"])
+                    p.append(f"{path.params['lw']} w {color} RG S\n")
+                    write(compressor.compress("\n".join(p).encode("latin-1")))
+        write(compressor.flush())
+        length = pos - start
+        write(b"\nendstream\nendobj\n")
+        write_object(5, str(length))
+
+        font_refs = []
+        for num, (font, name) in enumerate(fonts.items(), 6):
+            write_object(num, f"<< /Type /Font /Subtype /Type1 /BaseFont /{font} /Encoding /WinAnsiEncoding >>")
+            font_refs.append(f"/{name} {num} 0 R")
+        write_object(3, f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {w:.3f} {h:.3f}] "
+                     f"/Contents 4 0 R /Resources << /Font << {' '.join(font_refs)} >> >> >>")
+        write_object(2, "<< /Type /Pages /Kids [3 0 R] /Count 1 >>")
+        write_object(1, "<< /Type /Catalog /Pages 2 0 R >>")
+        info = 6 + len(fonts)
+        write_object(info, self._info())
+
+        xref = pos
+        entries = ["0000000000 65535 f \n"]
+        entries.extend(f"{offsets[i]:010d} 00000 n \n" for i in range(1, info + 1))
+        write((f"xref\n0 {info + 1}\n" + "".join(entries) +
+               f"trailer\n<< /Size {info + 1} /Root 1 0 R /Info {info} 0 R >>\n"
+               f"startxref\n{xref}\n%%EOF\n").encode("latin-1"))
+        if stream is None:
+            data.seek(0)
         return data
 
 class LBRN2Surface(Surface):
@@ -771,7 +1365,11 @@ class LBRN2Surface(Surface):
         8,  # Colors.OUTER_CUT    (WHITE)   --> Lightburn C08 (grey)
         ]
 
-    def finish(self, inner_corners="loop"):
+    def finish(self, inner_corners="loop", stream=None):
+        """Write the LightBurn project
+
+        :param stream: binary file like object, file descriptor or file name to write to, a new BytesIO if None
+        """
         if self.dbg: print("LBRN2 save")
         extents = self._adjust_coordinates()
         w = extents.width * self.scale
@@ -845,23 +1443,24 @@ class LBRN2Surface(Surface):
                 start = None
                 last = None
                 path.faster_edges(inner_corners)
+                commands = path.path
                 num = 0
                 cnt = 1
-                end = len(path.path) - 1
+                end = len(commands) - 1
                 if self.dbg:
-                    for c in path.path:
+                    for c in commands:
                         print ("6",num, c)
                         num += 1
                     num = 0
 
-                c = path.path[num]
+                c = commands[num]
                 C, x, y = c[0:3]
                 if self.dbg:
                     print("end:", end)
                 while num < end or (C == "T" and num <= end):  # len(path.path):
                     if self.dbg:
                         print("0", num)
-                    c = path.path[num]
+                    c = commands[num]
                     if self.dbg: print("first: ", num, c)
 
                     C, x, y = c[0:3]
@@ -871,11 +1470,12 @@ class LBRN2Surface(Surface):
                         sh.text = "\n  "
                         sh.tail = "\n"
                         vl = ET.SubElement(sh, "VertList")
-                        vl.text = f"V{x:.3f} {y:.3f}c0x1c1x1"
                         vl.tail = "\n"
                         pl = ET.SubElement(sh, "PrimList")
-                        pl.text = ""#f"L{cnt} {cnt+1}"
                         pl.tail = "\n"
+                        # collect the pieces and join them once the shape is done
+                        verts = [f"V{x:.3f} {y:.3f}c0x1c1x1"]
+                        prims = []
                         start = c
                         x0, y0 = x, y
                         # do something with M
@@ -883,12 +1483,12 @@ class LBRN2Surface(Surface):
                         bspline = False
                         while done == False and num < end:  # len(path.path):
                             num += 1
-                            c = path.path[num]
+                            c = commands[num]
                             if self.dbg: print ("next: ",num, c)
                             C, x, y = c[0:3]
                             if C == "M":
                                 if start and points_equal(start[1], start[2], x0, y0):
-                                    pl.text += f"L{cnt-1} 0"
+                                    prims.append(f"L{cnt-1} 0")
                                 start = c
                                 cnt = 1
                                 if self.dbg: print ("next, because M")
@@ -898,14 +1498,14 @@ class LBRN2Surface(Surface):
                                 done = True
                             else:
                                 if C == "L":
-                                    vl.text+=(f"V{x:.3f} {y:.3f}c0x1c1x1")
-                                    pl.text += f"L{cnt-1} {cnt}"
+                                    verts.append(f"V{x:.3f} {y:.3f}c0x1c1x1")
+                                    prims.append(f"L{cnt-1} {cnt}")
                                     cnt +=1
                                 elif C == "C":
                                     x1, y1, x2, y2 = c[3:]
                                     if self.dbg: print ("C: ",x0, y0, x1, y1, x, y, x2, y2)
-                                    vl.text+=(f"V{x0:.3f} {y0:.3f}c0x{(x1):.3f}c0y{(y1):.3f}c1x1V{x:.3f} {y:.3f}c0x1c1x{(x2):.3f}c1y{(y2):.3f}")
-                                    pl.text += f"L{cnt-1} {cnt}B{cnt} {cnt+1}"
+                                    verts.append(f"V{x0:.3f} {y0:.3f}c0x{(x1):.3f}c0y{(y1):.3f}c1x1V{x:.3f} {y:.3f}c0x1c1x{(x2):.3f}c1y{(y2):.3f}")
+                                    prims.append(f"L{cnt-1} {cnt}B{cnt} {cnt+1}")
                                     cnt +=2
                                     bspline = True
                                 else:
@@ -915,9 +1515,11 @@ class LBRN2Surface(Surface):
 
                         if start and points_equal(start[1], start[2], x0, y0):
                                 if bspline == False:
-                                    pl.text = "LineClosed"
+                                    prims = ["LineClosed"]
                                 else:
-                                    pl.text += f"L{cnt-1} 0"
+                                    prims.append(f"L{cnt-1} 0")
+                        vl.text = "".join(verts)
+                        pl.text = "".join(prims)
                         start = c
                         if self.dbg: print ("2", num)
                     elif C == "T":
@@ -1000,10 +1602,364 @@ class LBRN2Surface(Surface):
         pl.tail = "\n"
 
         if self.dbg: print ("5", num)
-        f = io.BytesIO()
-        tree.write(f, encoding="utf-8", xml_declaration=True, method="xml")
-        f.seek(0)
-        return f
+        with open_output(stream) as f:
+            tree.write(f, encoding="utf-8", xml_declaration=True, method="xml")
+        if stream is None:
+            f.seek(0)
+            return f
+        return stream
+
+class DXFSurface(Surface):
+    """DXF R12 (AC1009) drawing in mm
+
+    Paths become POLYLINE entities, text becomes TEXT entities. R12 has no
+    splines, so Bezier curves are flattened to line segments like pstoedit did.
+    R12 has no header variables for the units either ($INSUNITS came with
+    R14), so programs reading the file need to be told the units are mm.
+    """
+
+    invert_y = False
+    flatness = 0.1  # max distance of the segments from the curves in mm
+
+    # layer name and AutoCAD color index by 4*r + 2*g + b
+    dxf_layers = [
+        ("OUTER_CUT", 7),      # BLACK
+        ("INNER_CUT", 5),      # BLUE
+        ("ETCHING", 3),        # GREEN
+        ("ETCHING_DEEP", 4),   # CYAN
+        ("ANNOTATIONS", 1),    # RED
+        ("MAGENTA", 6),
+        ("YELLOW", 2),
+        ("WHITE", 8),          # grey to be visible on white background
+    ]
+
+    @staticmethod
+    def _layer(rgb):
+        return DXFSurface.dxf_layers[4*int(rgb[0])+2*int(rgb[1])+int(rgb[2])][0]
+
+    @staticmethod
+    def _text(text):
+        # R12 files are plain ASCII, other characters need unicode escapes
+        return "".join(c if 31 < ord(c) < 127 else f"\\U+{ord(c):04X}"
+                       for c in text)
+
+    def _metadata(self):
+        md = self.metadata
+        lines = ["Boxes.py - {group} - {name}".format(**md)]
+        if not md["reproducible"]:
+            lines.append(f'Creation date: {md["creation_date"].strftime("%Y-%m-%d %H:%M:%S")}')
+        lines.append("Created by Boxes.py (https://boxes.hackerspace-bamberg.de/)")
+        lines.extend((md["short_description"] or "").split("\n"))
+        if md.get("description"):
+            lines.extend(md["description"].split("\n"))
+        lines.append(f'Command line: {md["cli"]}')
+        if md["url"]:
+            lines.append(f'Url: {md["url"]}')
+        return "".join(f"999\n{self._text(line)}\n" for line in lines)
+
+    def _polyline(self, layer, points):
+        closed = len(points) > 2 and points_equal(*points[0], *points[-1])
+        if closed:
+            points = points[:-1]
+        out = [f"0\nPOLYLINE\n8\n{layer}\n66\n1\n10\n0.0\n20\n0.0\n30\n0.0\n70\n{int(closed)}\n"]
+        for x, y in points:
+            out.append(f"0\nVERTEX\n8\n{layer}\n10\n{x:.3f}\n20\n{y:.3f}\n30\n0.0\n")
+        out.append(f"0\nSEQEND\n8\n{layer}\n")
+        return "".join(out)
+
+    def finish(self, inner_corners="loop", stream=None):
+        """Write the DXF document
+
+        :param stream: binary file like object, file descriptor or file name to write to, a new BytesIO if None
+        """
+        if isinstance(stream, (int, str, os.PathLike)):
+            with open_output(stream) as f:
+                self.finish(inner_corners, f)
+            return stream
+
+        extents = self._adjust_coordinates()
+        w = extents.width
+        h = extents.height
+
+        data = io.BytesIO() if stream is None else stream
+        f = codecs.getwriter('ascii')(data)
+
+        f.write(self._metadata())
+        f.write(f"""0
+SECTION
+2
+HEADER
+9
+$ACADVER
+1
+AC1009
+9
+$EXTMIN
+10
+0.0
+20
+0.0
+9
+$EXTMAX
+10
+{w:.3f}
+20
+{h:.3f}
+0
+ENDSEC
+0
+SECTION
+2
+TABLES
+0
+TABLE
+2
+LTYPE
+70
+1
+0
+LTYPE
+2
+CONTINUOUS
+70
+0
+3
+Solid line
+72
+65
+73
+0
+40
+0.0
+0
+ENDTAB
+0
+TABLE
+2
+LAYER
+70
+{len(self.dxf_layers)}
+""")
+        for name, color in self.dxf_layers:
+            f.write(f"0\nLAYER\n2\n{name}\n70\n0\n62\n{color}\n6\nCONTINUOUS\n")
+        f.write("""0
+ENDTAB
+0
+TABLE
+2
+STYLE
+70
+1
+0
+STYLE
+2
+STANDARD
+70
+0
+40
+0.0
+41
+1.0
+50
+0.0
+71
+0
+42
+2.5
+3
+txt
+4
+
+0
+ENDTAB
+0
+ENDSEC
+0
+SECTION
+2
+ENTITIES
+""")
+        for part in self.parts:
+            for path in part.pathes:
+                path.faster_edges(inner_corners)
+                layer = self._layer(path.params["rgb"])
+                points = []
+                for c in path.path:
+                    C, x, y = c[0:3]
+                    if C == "M":
+                        if len(points) > 1:
+                            f.write(self._polyline(layer, points))
+                        points = [(x, y)]
+                    elif C == "L":
+                        points.append((x, y))
+                    elif C == "C":
+                        x1, y1, x2, y2 = c[3:]
+                        points.extend(flatten_curve(*points[-1], x1, y1, x2, y2, x, y, self.flatness))
+                    elif C == "T":
+                        m, text, params = c[3:]
+                        if not text:
+                            continue
+                        # height and direction of the text's y axis
+                        height = params["fs"] * math.hypot(m.b, m.e)
+                        angle = math.degrees(math.atan2(m.d, m.a))
+                        align = {"middle": 1, "end": 2}.get(params.get("align", "left"), 0)
+                        f.write(f"0\nTEXT\n8\n{self._layer(params['rgb'])}\n"
+                                f"10\n{m.c:.3f}\n20\n{m.f:.3f}\n30\n0.0\n"
+                                f"40\n{height:.3f}\n1\n{self._text(text)}\n50\n{angle:.3f}\n"
+                                f"72\n{align}\n11\n{m.c:.3f}\n21\n{m.f:.3f}\n31\n0.0\n73\n1\n")
+                    else:
+                        print("Unknown", c)
+                if len(points) > 1:
+                    f.write(self._polyline(layer, points))
+        f.write("0\nENDSEC\n0\nEOF\n")
+        if stream is None:
+            data.seek(0)
+        return data
+
+class ToolpathSurface(Surface):
+    """Base for surfaces that drive a machine directly
+
+    Lines are cut color by color in the order LBRN2Surface uses, inner cuts
+    before outer cuts, and in a nearest neighbour tour within each color.
+    Annotations and text are not cut. Curves are flattened to lines.
+    """
+
+    flatness = 0.1  # max distance of the lines from the curves in mm
+
+    # position in the cut order by 4*r + 2*g + b, None for not cut
+    cut_priority = [
+        6,     # Colors.OUTER_CUT    (BLACK)
+        5,     # Colors.INNER_CUT    (BLUE)
+        0,     # Colors.ETCHING      (GREEN)
+        1,     # Colors.ETCHING_DEEP (CYAN)
+        None,  # Colors.ANNOTATIONS  (RED)
+        2,     # MAGENTA
+        3,     # YELLOW
+        4,     # WHITE
+    ]
+
+    def toolpaths(self, inner_corners="loop"):
+        """Lines to cut in the order to cut them
+
+        :return: list of (color index, list of points)
+        """
+        by_color = {}
+        for part in self.parts:
+            for path in part.pathes:
+                path.faster_edges(inner_corners)
+                rgb = path.params["rgb"]
+                color = 4*int(rgb[0]) + 2*int(rgb[1]) + int(rgb[2])
+                if self.cut_priority[color] is None:
+                    continue
+                lines = by_color.setdefault(color, [])
+                points = []
+                for c in path.path:
+                    C, x, y = c[0:3]
+                    if C == "M":
+                        if len(points) > 1:
+                            lines.append(points)
+                        points = [(x, y)]
+                    elif C == "L":
+                        points.append((x, y))
+                    elif C == "C":
+                        x1, y1, x2, y2 = c[3:]
+                        points.extend(flatten_curve(*points[-1], x1, y1, x2, y2, x, y,
+                                                    self.flatness * self.scale))
+                if len(points) > 1:
+                    lines.append(points)
+
+        result = []
+        x = y = 0.0
+        for color in sorted(by_color, key=lambda c: self.cut_priority[c]):
+            lines = by_color[color]
+            if not lines:
+                continue
+            order = nearest_neighbour_order([l[0] for l in lines],
+                                            [l[-1] for l in lines], x, y)
+            result.extend((color, lines[i]) for i in order)
+            x, y = lines[order[-1]][-1]
+        return result
+
+
+class GCodeSurface(ToolpathSurface):
+    """G-code in mm for laser cutters, switching the tool on with M3"""
+
+    feed = 1000  # mm/min
+    power = 1000  # spindle speed or laser power
+
+    def _comments(self):
+        md = self.metadata
+        lines = ["Boxes.py - {group} - {name}".format(**md)]
+        if not md["reproducible"]:
+            lines.append(f'Creation date: {md["creation_date"].strftime("%Y-%m-%d %H:%M:%S")}')
+        lines.append(f'Command line: {md["cli"]}')
+        if md["url"]:
+            lines.append(f'Url: {md["url"]}')
+        return lines
+
+    def finish(self, inner_corners="loop", stream=None):
+        """Write the G-code
+
+        :param stream: binary file like object, file descriptor or file name to write to, a new BytesIO if None
+        """
+        if isinstance(stream, (int, str, os.PathLike)):
+            with open_output(stream) as f:
+                self.finish(inner_corners, f)
+            return stream
+
+        self._adjust_coordinates()
+
+        data = io.BytesIO() if stream is None else stream
+        f = codecs.getwriter('ascii')(data, errors="replace")
+        for line in self._comments():
+            f.write(f"; {line}\n")
+        f.write("G21\nG90\nM5\n")
+        for color, points in self.toolpaths(inner_corners):
+            x, y = points[0]
+            out = [f"G0 X{x:.3f} Y{y:.3f}", f"M3 S{self.power}"]
+            x, y = points[1]
+            out.append(f"G1 X{x:.3f} Y{y:.3f} F{self.feed}")
+            out.extend(f"G1 X{x:.3f} Y{y:.3f}" for x, y in points[2:])
+            out.append("M5\n")
+            f.write("\n".join(out))
+        f.write("G0 X0 Y0\nM2\n")
+        if stream is None:
+            data.seek(0)
+        return data
+
+
+class HPGLSurface(ToolpathSurface):
+    """HPGL with one pen per color in cut order"""
+
+    scale = 40.0  # plotter units per mm
+
+    def finish(self, inner_corners="loop", stream=None):
+        """Write the HPGL
+
+        :param stream: binary file like object, file descriptor or file name to write to, a new BytesIO if None
+        """
+        if isinstance(stream, (int, str, os.PathLike)):
+            with open_output(stream) as f:
+                self.finish(inner_corners, f)
+            return stream
+
+        self._adjust_coordinates()
+
+        data = io.BytesIO() if stream is None else stream
+        f = codecs.getwriter('ascii')(data)
+        f.write("IN;\n")
+        pen = None
+        for color, points in self.toolpaths(inner_corners):
+            if self.cut_priority[color] + 1 != pen:
+                pen = self.cut_priority[color] + 1
+                f.write(f"SP{pen};\n")
+            x, y = points[0]
+            f.write(f"PU{x:.0f},{y:.0f};\nPD" +
+                    ",".join(f"{x:.0f},{y:.0f}" for x, y in points[1:]) + ";\n")
+        f.write("PU0,0;\nSP0;\n")
+        if stream is None:
+            data.seek(0)
+        return data
 
 from random import random
 
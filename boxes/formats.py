@@ -14,32 +14,15 @@
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import os
 import shutil
-import subprocess
-import tempfile
-import io
-from boxes.drawing import Context, LBRN2Surface, PSSurface, SVGSurface
+from boxes.drawing import (Context, DXFSurface, GCodeSurface, HPGLSurface, LBRN2Surface,
+                           PDFSurface, PSSurface, SVGSurface, open_output)
 
 
 class Formats:
 
-    pstoedit_candidates = ["/usr/bin/pstoedit", "pstoedit", r"C:\Program Files\pstoedit\pstoedit.exe", "pstoedit.exe"]
-    ps2pdf_candidates = ["/usr/bin/ps2pdf", "ps2pdf", "ps2pdf.exe"]
-
-    _BASE_FORMATS = ['svg', 'svg_Ponoko', 'ps', 'lbrn2']
-
-    formats = {
-        "svg": None,
-        "svg_Ponoko": None,
-        "ps": None,
-        "lbrn2": None,
-        "dxf": "{pstoedit} -flat 0.1 -f dxf:-mm {input} {output}",
-        "gcode": "{pstoedit} -f gcode {input} {output}",
-        "plt": "{pstoedit} -f hpgl {input} {output}",
-        # "ai": "{pstoedit} -f ps2ai",
-        "pdf": "{ps2pdf} -dEPSCrop {input} {output}",
-    }
+    # all formats are written by the surfaces in boxes.drawing
+    formats = ['svg', 'svg_Ponoko', 'ps', 'lbrn2', 'dxf', 'pdf', 'gcode', 'plt']
 
     http_headers = {
         "svg": [('Content-type', 'image/svg+xml; charset=utf-8')],
@@ -47,63 +30,51 @@ class Formats:
         "ps": [('Content-type', 'application/postscript')],
         "lbrn2": [('Content-type', 'application/lbrn2')],
         "dxf": [('Content-type', 'image/vnd.dxf')],
+        "pdf": [('Content-type', 'application/pdf')],
         "plt": [('Content-type', ' application/vnd.hp-hpgl')],
         "gcode": [('Content-type', 'text/plain; charset=utf-8')],
 
         # "" : [('Content-type', '')],
     }
 
-    def __init__(self) -> None:
-        for cmd in self.pstoedit_candidates:
-            self.pstoedit = shutil.which(cmd)
-            if self.pstoedit:
-                break
-        for cmd in self.ps2pdf_candidates:
-            self.ps2pdf = shutil.which(cmd)
-            if self.ps2pdf:
-                break
-
     def getFormats(self):
-        if self.pstoedit:
-            return sorted(self.formats.keys())
-        return self._BASE_FORMATS
+        return self.formats
 
-    def getSurface(self, fmt):
+    def getSurface(self, fmt, **options):
+        """Create surface and context for fmt
+
+        :param options: passed on to the surface, e.g. compact=True
+        """
         if fmt in ("svg", "svg_Ponoko"):
-            surface = SVGSurface()
+            surface = SVGSurface(**options)
         elif fmt == "lbrn2":
-            surface = LBRN2Surface()
+            surface = LBRN2Surface(**options)
+        elif fmt == "dxf":
+            surface = DXFSurface(**options)
+        elif fmt == "pdf":
+            surface = PDFSurface(**options)
+        elif fmt == "gcode":
+            surface = GCodeSurface(**options)
+        elif fmt == "plt":
+            surface = HPGLSurface(**options)
         else:
-            surface = PSSurface()
+            surface = PSSurface(**options)
 
         ctx = Context(surface)
         return surface, ctx
 
-    def convert(self, data, fmt):
-
-        if fmt not in self._BASE_FORMATS:
-            fd, tmpfile = tempfile.mkstemp()
-            try:
-                os.write(fd, data.getvalue())
-                os.close(fd)
-                fd2, outfile = tempfile.mkstemp()
-                try:
-                    cmd = self.formats[fmt].format(
-                        pstoedit=self.pstoedit,
-                        ps2pdf=self.ps2pdf,
-                        input=tmpfile,
-                        output=outfile).split()
-                    result = subprocess.run(cmd)
-
-                    if result.returncode:
-                        # XXX show stderr output
-                        raise ValueError("Conversion failed. pstoedit returned %i\n\n %s" % (result.returncode, result.stderr))
-                    with open(outfile, 'rb') as ff:
-                        data = io.BytesIO(ff.read())
-                finally:
-                    os.close(fd2)
-                    os.unlink(outfile)
-            finally:
-                os.unlink(tmpfile)
-
+    def convert(self, data, fmt, output=None):
+        """Write the surface output in fmt
+
+        :param data: BytesIO with the output or callable writing it into the binary stream passed
+        :param output: binary stream, file descriptor or file name to write to, a new BytesIO if None
+        """
+        if fmt not in self.formats:
+            raise ValueError(f"unknown format '{fmt}'")
+        if callable(data):
+            return data(output)
+        if output is not None:
+            with open_output(output) as f:
+                shutil.copyfileobj(data, f)
+            return output
         return data
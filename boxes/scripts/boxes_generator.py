@@ -84,12 +84,10 @@ import argparse
 import sys
 import uuid
 import os
-import re
 
 import xml.etree.ElementTree as ET
 import rectpack
 from rectpack import newPacker, PackingBin
-from svgpathtools import parse_path
 
 try:
     import boxes.generators
@@ -97,6 +95,8 @@ except ImportError:
     sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "../.."))
     import boxes.generators
 import boxes
+from boxes.scripts.boxes_main import write_copies
+from boxes.svgmerge import SvgMerge
 
 class ArgumentParserError(Exception): pass
 
@@ -175,9 +175,15 @@ def generate_layout(box):
     layout += "+-" * countx + "+\n"
     return layout
 
-def generate(cut, output_prefix, format="svg"):
+def generate(cut, output_prefix, format="svg", links=False, rendered=None):
     """
     Generate a single box
+
+    Copies of boxes with a count are hardlinked to the first file if links
+    is set. For SVG output (output_file, count, groups) of each box is
+    appended to rendered if given, with the parts as ElementTree groups
+    and their extents. This way they can be merged without parsing the
+    files again.
     """
     generated_files = []
     defaults = cut.get("Defaults", {})
@@ -237,7 +243,7 @@ def generate(cut, output_prefix, format="svg"):
         # Render the box SVG
         box.open()
         box.render()
-        data = box.close()
+        data = box.close().getvalue()
 
         if box_settings.get("name") is not None:
             output_base = os.path.basename(output_prefix)
@@ -248,105 +254,37 @@ def generate(cut, output_prefix, format="svg"):
 
         # Write the output
         if box_settings.get("count") is not None:
-            for jj in range(int(box_settings.get("count"))):
-                logging.info("Writing %s_%s.%s", output_file, jj, format)
-                with open(f"{output_file}_{jj}.{format}", "wb") as ff:
-                    ff.write(data.read())
-                    data.seek(0)
-                generated_files.append(f"{output_file}_{jj}.{format}")
-
+            count = int(box_settings.get("count"))
+            output_files = [f"{output_file}_{jj}.{format}" for jj in range(count)]
         else:
-            logging.info("Writing %s.%s", output_file, format)
-            with open(f"{output_file}.{format}", "wb") as ff:
-                ff.write(data.read())
-            generated_files.append(f"{output_file}.{format}")
+            count = 1
+            output_files = [f"{output_file}.{format}"]
+        write_copies(data, output_files, link=links, log=logging.info)
+        generated_files.extend(output_files)
+        if rendered is not None and format == "svg":
+            rendered.append((output_files[0], count, box.surface.part_groups()))
 
     return generated_files
 
-def parse_svg_groups(svg_file):
-    """
-    Parse out all the SVG groups from the given SVG file
-    """
-    tree = ET.parse(svg_file)
-    root = tree.getroot()
-    groups = [g for g in root if g.tag.endswith('g')]
-    return groups, tree
+# read bounding boxes the same way as boxes --merge
+parse_svg_groups = SvgMerge.parse_svg_groups
+get_bbox_of_group = SvgMerge.get_bbox_of_group
 
-def get_bbox_of_group(group):
+def group_elements(groups, source_file, count=1):
     """
-    Get the bounding box of the SVG group
-    """
-    min_x = float("inf")
-    min_y = float("inf")
-    max_x = float("-inf")
-    max_y = float("-inf")
-
-    def update_bbox(x_vals, y_vals):
-        nonlocal min_x, min_y, max_x, max_y
-        min_x = min(min_x, *x_vals)
-        min_y = min(min_y, *y_vals)
-        max_x = max(max_x, *x_vals)
-        max_y = max(max_y, *y_vals)
-
-    for elem in group.iter():
-        tag = elem.tag.split("}")[-1]  # Remove namespace
-        if tag == "rect":
-            x = float(elem.attrib.get("x", 0))
-            y = float(elem.attrib.get("y", 0))
-            w = float(elem.attrib.get("width", 0))
-            h = float(elem.attrib.get("height", 0))
-            update_bbox([x, x + w], [y, y + h])
-        elif tag == "circle":
-            cx = float(elem.attrib.get("cx", 0))
-            cy = float(elem.attrib.get("cy", 0))
-            r = float(elem.attrib.get("r", 0))
-            update_bbox([cx - r, cx + r], [cy - r, cy + r])
-        elif tag == "ellipse":
-            cx = float(elem.attrib.get("cx", 0))
-            cy = float(elem.attrib.get("cy", 0))
-            rx = float(elem.attrib.get("rx", 0))
-            ry = float(elem.attrib.get("ry", 0))
-            update_bbox([cx - rx, cx + rx], [cy - ry, cy + ry])
-        elif tag == "line":
-            x1 = float(elem.attrib.get("x1", 0))
-            y1 = float(elem.attrib.get("y1", 0))
-            x2 = float(elem.attrib.get("x2", 0))
-            y2 = float(elem.attrib.get("y2", 0))
-            update_bbox([x1, x2], [y1, y2])
-        elif tag in ["polyline", "polygon"]:
-            points = elem.attrib.get("points", "")
-            point_pairs = re.findall(r"[-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?", points)
-            coords = list(map(float, point_pairs))
-            xs = coords[::2]
-            ys = coords[1::2]
-            if xs and ys:
-                update_bbox(xs, ys)
-        elif tag == "path":
-            d = elem.attrib.get("d", "")
-            try:
-                path = parse_path(d)
-                box = path.bbox()  # (min_x, max_x, min_y, max_y)
-                update_bbox([box[0], box[1]], [box[2], box[3]])
-            except Exception as e:
-                print(f"Warning: Failed to parse path in group. Error: {e}")
-
-    # Fallback if nothing was found
-    if min_x == float("inf"):
-        raise ValueError
-    return [min_x, min_y, max_x, max_y]
+    Elements to pack for groups with known bounding boxes
 
-def extract_elements(svg_files):
-    """
-    Extract all group elements from the SVG
+    groups is a list of (group, bbox) with bbox as [min_x, min_y, max_x, max_y]
+    or Extents, e.g. from SVGSurface.part_groups().
     """
     elements = []
-    for file in svg_files:
-        groups, tree = parse_svg_groups(file)
-        for g in groups:
-            bbox = get_bbox_of_group(g)
-            width = bbox[2] - bbox[0]
-            height = bbox[3] - bbox[1]
-            style = g.attrib.get("style", '')
+    for g, bbox in groups:
+        if not isinstance(bbox, list):
+            bbox = [bbox.xmin, bbox.ymin, bbox.xmax, bbox.ymax]
+        width = bbox[2] - bbox[0]
+        height = bbox[3] - bbox[1]
+        style = g.attrib.get("style", '')
+        for _ in range(count):
             elements.append({
                 'group': g,
                 'bbox': bbox,
@@ -354,7 +292,7 @@ def extract_elements(svg_files):
                 'height': height,
                 'style': style,
                 'id': str(uuid.uuid4()),
-                'source_file': file
+                'source_file': source_file
             })
     return elements
 
@@ -494,6 +432,7 @@ def create_output_svg(packed_elements, box_width, box_height, margin, include_de
 
 def main(args):
     generated_files = set()
+    rendered = []
     for cut_file in args.cuts:
         output_prefix = args.prefix
         if output_prefix is None:
@@ -501,7 +440,7 @@ def main(args):
 
         with open(cut_file) as ff:
             cut = yaml.safe_load(ff)
-            generated_files.update( generate(cut, output_prefix, args.format) )
+            generated_files.update( generate(cut, output_prefix, args.format, args.links, rendered) )
 
     # convert width/height in mm to pixels
     if args.panel_width > 0 and args.panel_height > 0 and args.merge and args.format == "svg":
@@ -510,7 +449,10 @@ def main(args):
         margin_px = int( (args.margin / 25.4) * 96)
 
         logging.info("Merging %s files", len(generated_files))
-        elements = extract_elements(list(generated_files))
+        # merge the parts and copies from memory instead of parsing every file
+        elements = []
+        for output_file, count, groups in rendered:
+            elements.extend(group_elements(groups, output_file, count))
         for element in elements:
             if element['width'] > args.panel_width or element['height'] > args.panel_height:
                 logging.warning("Element in %s is larger than panel width and will not be included in merged output", element['source_file'])
@@ -551,6 +493,7 @@ if __name__ == "__main__":
     parser.add_argument("--margin", type=int, default=1, help="margin around outside of element in mm")
     parser.add_argument("--output", default="merged_output.svg", help="Merged output SVG file suffix")
     parser.add_argument("--merge", default=False, action="store_true", help="Produce merged output")
+    parser.add_argument("--links", default=False, action="store_true", help="Hardlink the copies of boxes with a count instead of writing them")
     parser.add_argument("--format",
         action="store",
         type=str,
@@ -11,6 +11,11 @@ import os
 import sys
 import copy
 import argparse
+import concurrent.futures
+import functools
+import glob
+import inspect
+import json
 import logging
 import hashlib
 from pathlib import Path
@@ -21,6 +26,7 @@ except ImportError:
     sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../..'))
     import boxes
 
+import boxes.formats
 import boxes.generators
 import boxes.svgmerge
 
@@ -51,7 +57,27 @@ def print_grouped_generators() -> None:
             description = description.replace("\n", "").replace("\r", "").strip()
             print(f' *  {box.__name__:<15} - {ConsoleColors.ITALIC}{description}{ConsoleColors.CLEAR}')
 
-def multi_generate(config_path : Path|str|TextIO, output_path : Path|str, output_name_formater=None, format="svg") -> list[str]:
+# Records which files were written from which settings, see multi_generate()
+MANIFEST_NAME = ".boxes-manifest.json"
+
+# How multi_generate() writes boxes with a count: a file per copy, one file
+# and hardlinks to it or one file with the count recorded in the manifest
+COPIES_MODES = ("files", "links", "count")
+
+
+def multi_generate(config_path : Path|str|TextIO, output_path : Path|str, output_name_formater=None, format="svg", surface_options=None, jobs=1, force=False, copies="files") -> list[str]:
+    """Render the boxes of a YAML configuration
+
+    Boxes are skipped if their files were written from the same settings
+    and code before and were not changed since. This is recorded in a
+    manifest file in output_path.
+
+    :param jobs: number of processes rendering in parallel, None for one per CPU
+    :param force: render all boxes again
+    :param copies: how to write boxes with a count, one of COPIES_MODES
+    """
+    if copies not in COPIES_MODES:
+        raise ValueError(f"invalid copies mode '{copies}'")
     if isinstance(config_path, str) or isinstance(config_path, Path):
         with open(config_path) as ff:
             config_data = yaml.safe_load(ff)
@@ -64,6 +90,8 @@ def multi_generate(config_path : Path|str|TextIO, output_path : Path|str, output
     generated_files = []
     defaults = config_data.get("Defaults", {})
 
+    # collect everything to render first, so it can be done in parallel
+    tasks = []
     for ii, box_settings in enumerate(config_data.get("Boxes", [])):
         # Allow for skipping generation
         if box_settings.get("generate") == False:
@@ -77,9 +105,9 @@ def multi_generate(config_path : Path|str|TextIO, output_path : Path|str, output
         # __ALL__ is a special case
         box_classes: tuple|None = None
         if box_type != "__ALL__":
-            box_classes = ( generators_by_name.get(box_type, None), )
-            if box_classes is None:
+            if box_type not in generators_by_name:
                 raise ValueError("invalid generator '%s'" % box_type)
+            box_classes = ( generators_by_name[box_type], )
         else:
             skipGenerators = set(box_settings.get("skipGenerators", []))
             brokenGenerators = set(box_settings.get("brokenGenerators", []))
@@ -87,87 +115,48 @@ def multi_generate(config_path : Path|str|TextIO, output_path : Path|str, output
             box_classes = tuple(filter(lambda x: x.__name__ not in avoidGenerators, all_generators.values()))
 
         for box_cls in box_classes:
-            box_cls_name = box_cls.__name__
-
-            # Instantitate the box object
-            box = box_cls()
-            box.translations = get_translation()
-
-            # Create the settings for the generator
-            settings = copy.deepcopy(defaults)
-            settings.update(box_settings.get("args", {}))
-
-            # Handle layout separately
-            if hasattr(box, "layout") and "layout" in settings:
-                if os.path.exists(settings["layout"]):
-                    with open(settings["layout"]) as ff:
-                        settings["layout"] = ff.read()
-                else:
-                    box.layout = settings["layout"]
-
-            # Turn the settings into arguments, but ignore format
-            # in the YAML file if provided and use the argument to the function
-            box_args = []
-            for kk, vv in settings.items():
-                # Handle format separately
-                if kk in ("format","layout"):
-                    continue
-                box_args.append(f"--{kk}={vv}")
-
-            # Layout has three options:
-            #  - provided verbatim in the YAML file
-            #  - provided as a path to a file in the YAML file
-            #  - using the special placeholder __GENERATE__ which will invoke the default
-            if "layout" in settings:
-                if os.path.exists(settings["layout"]):
-                    with open(settings["layout"]) as ff:
-                        layout = ff.read()
-                else:
-                    layout = settings["layout"]
-                box_args.append(f"--layout={layout}")
-
-            # SVG is default, only apply argument if changing default
-            if format != "svg":
-                box_args.append(f"--format={format}")
-
-            # Parse the box arguments - because we allow arguments at the
-            # top-level defaults, we ignore unknown arguments
-            try:
-                # Ignore unknown arguments by pre-parsing. This two stage
-                # approach was performed to avoid modifying parseArgs and
-                # changing it's behavior.  A long-term better solution
-                # might be to allow parseArgs to take a 'strict' argument
-                # the can enable/disable strict parsing of arguments
-                args, argv = box.argparser.parse_known_args(box_args)
-                if len(argv) > 0:
-                    for unknown_arg in argv:
-                        box_args.remove(unknown_arg)
-                box.parseArgs(box_args)
-            except ArgumentParserError:
-                print("Error parsing box args for box %s : %s", ii, box_cls_name)
-                continue
+            tasks.append((ii, box_cls.__name__, box_settings, defaults, format, surface_options))
+
+    manifest_path = os.path.join(output_path, MANIFEST_NAME)
+    manifest = {} if force else _load_manifest(manifest_path)
+    entries = manifest.get("entries", {})
+    counts = manifest.get("copies", {})
+    new_manifest: dict[str, list[str]] = {}
+    new_counts: dict[str, int] = {}
+    keys = [_task_hash(task, output_path, output_name_formater, copies) for task in tasks]
+    unchanged = [_files_unchanged(entries.get(key)) for key in keys]
+    todo = [task for task, skip in zip(tasks, unchanged) if not skip]
+
+    # the workers import the generators once (or get them from the parent when forked)
+    executor = concurrent.futures.ProcessPoolExecutor(jobs) if jobs != 1 and todo else None
+    results = executor.map(_generate_box, todo) if executor else map(_generate_box, todo)
 
-            # handle __GENERATE__ which must be called after parseArgs
-            if getattr(box, "layout", None) == "__GENERATE__":
-                if hasattr(box, "generate_layout") and callable(box.generate_layout):
-                    box.layout = box.generate_layout()
-                else:
-                    print("Error box %s : %s requires manual layout", ii, box_cls_name)
-                    continue
-
-            box.metadata["reproducible"] = True
+    try:
+        # write in the order of the configuration, whatever finishes first
+        for task, key, skip in zip(tasks, keys, unchanged):
+            ii, box_cls_name, box_settings, *_ = task
+            if skip:
+                new_manifest[key] = list(entries[key])
+                for output_file in entries[key]:
+                    print(f"Unchanged {output_file}")
+                    generated_files.append(output_file)
+                    name = os.path.basename(output_file)
+                    if name in counts:
+                        new_counts[name] = counts[name]
+                continue
 
-            # Render the box SVG
-            box.open()
-            box.render()
-            data = box.close()
+            result = next(results)
+            if isinstance(result, str):
+                print(result)
+                continue
+            box_args, metadata, data = result
 
             if callable(output_name_formater):
                 output_fname = output_name_formater(
                     box_type=box_cls_name,
                     name=box_settings.get("name", box_cls_name),
                     box_idx=ii,
-                    metadata=box.metadata,
+                    metadata=metadata,
                     box_args=box_args
                 )
             else:
@@ -175,28 +164,243 @@ def multi_generate(config_path : Path|str|TextIO, output_path : Path|str, output
                     box_type=box_cls_name,
                     name=box_settings.get("name", box_cls_name),
                     box_idx=ii,
-                    metadata=box.metadata,
+                    metadata=metadata,
                 )
 
             # Write the output - if count is provided generate multiple copies
-            if box_settings.get("count") is not None:
-                for jj in range(int(box_settings.get("count"))):
-                    output_file = os.path.join(output_path, f"{output_fname}_{jj}.{format}")
-                    print(f"Writing {output_file}")
-                    with open(output_file, "wb") as ff:
-                        ff.write(data.read())
-                        data.seek(0)
-                    generated_files.append(output_file)
-
+            if box_settings.get("count") is not None and copies != "count":
+                output_files = [os.path.join(output_path, f"{output_fname}_{jj}.{format}")
+                                for jj in range(int(box_settings.get("count")))]
             else:
-                output_file = os.path.join(output_path, f"{output_fname}.{format}")
-                print(f"Writing {output_file}")
-                with open(output_file, "wb") as ff:
-                    ff.write(data.read())
-                generated_files.append(output_file)
+                output_files = [os.path.join(output_path, f"{output_fname}.{format}")]
+                if box_settings.get("count") is not None:
+                    new_counts[os.path.basename(output_files[0])] = int(box_settings.get("count"))
+            write_copies(data, output_files, link=copies == "links")
+            generated_files.extend(output_files)
+            new_manifest.setdefault(key, []).extend(output_files)
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+        # also keep what is done if something failed
+        _save_manifest(manifest_path, new_manifest, new_counts)
 
     return generated_files
 
+
+@functools.cache
+def _source_hash(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+@functools.cache
+def _code_hash() -> str:
+    """Hash over the code of the whole package
+
+    Generators use the helpers of other modules and even other generators,
+    so a change anywhere may change their output.
+    """
+    package = os.path.dirname(boxes.__file__)
+    paths = glob.glob(os.path.join(package, "**", "*.py"), recursive=True)
+    return hashlib.sha256(" ".join(
+        f"{os.path.relpath(p, package)}:{_source_hash(p)}" for p in sorted(paths)).encode()).hexdigest()
+
+
+def write_copies(data: bytes, output_files: list[str], link=False, log=print) -> None:
+    """Write data to the first file and copy or hardlink it to the others
+
+    Copies are written if the file system does not support hardlinks.
+
+    :param log: called with a message for every file
+    """
+    for jj, output_file in enumerate(output_files):
+        if jj and link:
+            try:
+                if os.path.lexists(output_file):
+                    os.unlink(output_file)
+                os.link(output_files[0], output_file)
+                log(f"Linking {output_file}")
+                continue
+            except OSError:
+                link = False
+        log(f"Writing {output_file}")
+        with open(output_file, "wb") as ff:
+            ff.write(data)
+
+
+def _task_hash(task, output_path, output_name_formater, copies="files") -> str:
+    """Hash over everything the files of a multi_generate() task depend on"""
+    ii, box_cls_name, box_settings, defaults, format, surface_options = task
+    layouts = []
+    for settings in (defaults, box_settings.get("args", {})):
+        layout = settings.get("layout")
+        if isinstance(layout, str) and os.path.exists(layout):
+            layouts.append(_source_hash(layout))
+    try:
+        formater = inspect.getsource(output_name_formater)
+    except (TypeError, OSError):
+        formater = repr(output_name_formater)
+    content = json.dumps([ii, box_cls_name, box_settings, defaults, format, surface_options,
+                          layouts, str(output_path), formater, copies, _code_hash()],
+                         sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def _file_state(path) -> list[int]:
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _files_unchanged(files) -> bool:
+    if not files:
+        return False
+    try:
+        return all(_file_state(path) == state for path, state in files.items())
+    except OSError:
+        return False
+
+
+def _load_manifest(path) -> dict:
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+        return manifest if isinstance(manifest, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def load_copies(files) -> dict[str, int]:
+    """Counts of the given files written by multi_generate() with copies="count"
+
+    They are looked up in the manifests in the folders of the files. Files
+    not written that way are left out.
+    """
+    counts: dict[str, dict] = {}
+    result = {}
+    for fn in files:
+        folder, name = os.path.split(fn)
+        if folder not in counts:
+            counts[folder] = _load_manifest(os.path.join(folder, MANIFEST_NAME)).get("copies", {})
+        if name in counts[folder]:
+            result[fn] = counts[folder][name]
+    return result
+
+
+def _save_manifest(path, entries, counts=None) -> None:
+    """Save the files written for the task hashes with their current state
+
+    Taking the state only now keeps entries of files written by several
+    tasks valid. They have the content of the last task, like after
+    rendering everything.
+
+    Entries of other configurations writing to the same folder are kept.
+    Only those for files written now or removed since are dropped.
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        old = _load_manifest(path)
+        written = {fn for files in entries.values() for fn in files}
+        names = {os.path.basename(fn) for fn in written}
+        merged = {key: files for key, files in old.get("entries", {}).items()
+                  if isinstance(files, dict) and not written.intersection(files) and
+                  all(os.path.exists(fn) for fn in files)}
+        merged.update({key: {fn: _file_state(fn) for fn in files} for key, files in entries.items()})
+        copies = {name: count for name, count in old.get("copies", {}).items() if name not in names}
+        copies.update(counts or {})
+        with open(tmp, "w") as f:
+            json.dump({"version": 1, "entries": merged, "copies": copies}, f, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"Could not write {path}: {e}")
+
+
+@functools.cache
+def _generators_by_class_name() -> dict[str, type[boxes.Boxes]]:
+    return {b.__name__: b for b in boxes.generators.getAllBoxGenerators().values()}
+
+
+def _generate_box(task):
+    """Render one box for multi_generate(), possibly in a worker process
+
+    Returns (box_args, metadata, data) or a message if the box is skipped.
+    """
+    ii, box_cls_name, box_settings, defaults, format, surface_options = task
+    box_cls = _generators_by_class_name()[box_cls_name]
+
+    # Instantitate the box object
+    box = box_cls()
+    box.translations = get_translation()
+    if surface_options:
+        box.surface_options = dict(surface_options)
+
+    # Create the settings for the generator
+    settings = copy.deepcopy(defaults)
+    settings.update(box_settings.get("args", {}))
+
+    # Handle layout separately
+    if hasattr(box, "layout") and "layout" in settings:
+        if os.path.exists(settings["layout"]):
+            with open(settings["layout"]) as ff:
+                settings["layout"] = ff.read()
+        else:
+            box.layout = settings["layout"]
+
+    # Turn the settings into arguments, but ignore format
+    # in the YAML file if provided and use the argument to the function
+    box_args = []
+    for kk, vv in settings.items():
+        # Handle format separately
+        if kk in ("format","layout"):
+            continue
+        box_args.append(f"--{kk}={vv}")
+
+    # Layout has three options:
+    #  - provided verbatim in the YAML file
+    #  - provided as a path to a file in the YAML file
+    #  - using the special placeholder __GENERATE__ which will invoke the default
+    if "layout" in settings:
+        if os.path.exists(settings["layout"]):
+            with open(settings["layout"]) as ff:
+                layout = ff.read()
+        else:
+            layout = settings["layout"]
+        box_args.append(f"--layout={layout}")
+
+    # SVG is default, only apply argument if changing default
+    if format != "svg":
+        box_args.append(f"--format={format}")
+
+    # Parse the box arguments - because we allow arguments at the
+    # top-level defaults, we ignore unknown arguments
+    try:
+        # Ignore unknown arguments by pre-parsing. This two stage
+        # approach was performed to avoid modifying parseArgs and
+        # changing it's behavior.  A long-term better solution
+        # might be to allow parseArgs to take a 'strict' argument
+        # the can enable/disable strict parsing of arguments
+        args, argv = box.argparser.parse_known_args(box_args)
+        if len(argv) > 0:
+            for unknown_arg in argv:
+                box_args.remove(unknown_arg)
+        box.parseArgs(box_args)
+    except ArgumentParserError:
+        return f"Error parsing box args for box {ii} : {box_cls_name}"
+
+    # handle __GENERATE__ which must be called after parseArgs
+    if getattr(box, "layout", None) == "__GENERATE__":
+        if hasattr(box, "generate_layout") and callable(box.generate_layout):
+            box.layout = box.generate_layout()
+        else:
+            return f"Error box {ii} : {box_cls_name} requires manual layout"
+
+    box.metadata["reproducible"] = True
+
+    # Render the box SVG
+    box.open()
+    box.render()
+    data = box.close()
+    return box_args, box.metadata, data.getvalue()
+
 def get_translation():
     try:
         return gettext.translation('boxes.py', localedir='locale')
@@ -204,19 +408,19 @@ def get_translation():
         return gettext.translation('boxes.py', fallback=True)
 
 
-def run_generator(name: str, args) -> None:
+def run_generator(name: str, args, surface_options=None) -> None:
     generators = generators_by_name()
     lower_name = name.lower()
 
     if lower_name in generators.keys():
         box = generators[lower_name]()
         box.translations = get_translation()
+        if surface_options:
+            box.surface_options = dict(surface_options)
         box.parseArgs(args)
         box.open()
         box.render()
-        data = box.close()
-        with os.fdopen(sys.stdout.fileno(), "wb", closefd=False) if box.output == "-" else open(box.output, 'wb') as f:
-            f.write(data.getvalue())
+        box.close(sys.stdout.fileno() if box.output == "-" else box.output)
     else:
         msg = f"Unknown generator '{name}'. Use boxes --list to get a list of available commands.\n"
         sys.stderr.write(msg)
@@ -251,6 +455,12 @@ def print_version() -> None:
     print("boxes does not use versioning.")
 
 
+def print_formats() -> None:
+    print("Available formats:")
+    for fmt in boxes.formats.Formats().getFormats():
+        print(f" *  {fmt}")
+
+
 def example_output_fname_formatter(box_type, name, box_idx, metadata, box_args):
     if not box_args:
         return f"{name}"
@@ -267,28 +477,37 @@ def main() -> None:
     parser.add_argument("--debug", type=boxes.boolarg, default=False)
     parser.add_argument("--version", action="store_true", default=False)
     parser.add_argument("--list", action="store_true", default=False, help="List available generators.")
+    parser.add_argument("--formats", action="store_true", default=False, help="List available output formats.")
     parser.add_argument("--examples", action="store_true", default=False, help='Generates an SVG for every generator into the "examples" folder.')
     parser.add_argument("--help", action="store_true", default=False)
     parser.add_argument("--multi-generator", type=argparse.FileType('r', encoding='UTF-8'), help="Generate multiple boxes from a configuration YAML")
     parser.add_argument("--merge", action="store_true", default=False, help="Merge multiple SVG files into optimal cuts for a given panel size")
+    parser.add_argument("--force", action="store_true", default=False, help="Render all boxes for --examples and --multi-generator, not only changed ones")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of processes rendering for --examples and --multi-generator, 0 for one per CPU (default: 1)")
+    parser.add_argument("--copies", choices=COPIES_MODES, default="files", help="How to write boxes with a count for --multi-generator: a file per copy, hardlinks to one file or one file with the count in the manifest for --merge (default: files)")
+    parser.add_argument("--max-memory", type=boxes.argparseMemorySize, default=None, help="Abort if the drawing needs more memory, e.g. 500M (default: no limit)")
     args, extra = parser.parse_known_args()
-    if args.generator and (args.examples or args.multi_generator or args.list):
+    if args.generator and (args.examples or args.multi_generator or args.list or args.formats):
         parser.error("cannot combine --generator with other commands")
 
     # if debug is True set logging level
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
 
+    surface_options = {"compact": True, "max_memory": args.max_memory}
+
     # Handle various actions
     if args.version:
         print_version()
     elif args.list:
         print_grouped_generators()
+    elif args.formats:
+        print_formats()
     elif args.examples:
         print("Generating SVG examples for every possible generator.")
         config_path = Path(__file__).parent.parent.parent / 'examples.yml'
         output_path = Path("examples")
-        multi_generate(config_path, output_path, example_output_fname_formatter)
+        multi_generate(config_path, output_path, example_output_fname_formatter, surface_options=surface_options, jobs=args.jobs or None, force=args.force)
     elif args.multi_generator:
         try:
             if os.path.isdir(extra[0]):
@@ -310,11 +529,11 @@ def main() -> None:
             # No template has been provided, use defaults
             output_path = Path(".")
             output_fname_format = "{name}_{box_idx}"
-        multi_generate(args.multi_generator, output_path, output_fname_format)
+        multi_generate(args.multi_generator, output_path, output_fname_format, surface_options=surface_options, jobs=args.jobs or None, force=args.force, copies=args.copies)
     elif args.merge:
         merger = boxes.svgmerge.SvgMerge()
         merger.parseArgs(extra)
-        merger.render(extra)
+        merger.render(merger.cuts, load_copies(merger.cuts))
         data = merger.close()
         with os.fdopen(sys.stdout.fileno(), "wb", closefd=False) if merger.output == "-" else open(merger.output, 'wb') as f:
             f.write(data.getvalue())
@@ -330,7 +549,7 @@ def main() -> None:
             extra.append("--help")
         if args.debug:
             extra.extend(["--debug", "1"])
-        run_generator(name, extra)
+        run_generator(name, extra, surface_options)
 
 if __name__ == '__main__':
     # Setup basic logging
@@ -16,24 +16,40 @@
 from __future__ import annotations
 
 import argparse
+import concurrent.futures
 import gettext
 import glob
+import gzip
+import hashlib
 import html
 import io
+import json
 import mimetypes
 import os.path
+import queue
 import re
+import shutil
+import signal
+import socketserver
 import sys
+import tempfile
 import threading
 import time
 import traceback
+import uuid
+from collections import OrderedDict
 from typing import Any, NoReturn
 from urllib.parse import quote, unquote_plus
-from wsgiref.simple_server import make_server
+from wsgiref.simple_server import WSGIServer, make_server
 
 import markdown
 import qrcode
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 try:
     import boxes.generators
 except ImportError:
@@ -82,6 +98,120 @@ class FileChecker(threading.Thread):
         self._stopped = True
 
 
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class RequestTimeout(Exception):
+    pass
+
+
+class PreforkServer:
+    """Serve with several worker processes sharing one listening socket
+
+    Workers are forked after the generators are imported and the BServer is
+    set up, so those are shared copy-on-write. Workers are replaced after
+    max_requests requests and after a request ran into the timeout.
+    """
+
+    def __init__(self, httpd, workers=4, max_requests=0, timeout=0, filechecker=None, cleanup=None) -> None:
+        """
+        :param httpd: WSGIServer with the application set
+        :param workers: number of worker processes
+        :param max_requests: requests before a worker is replaced, 0 for no limit
+        :param timeout: limit for a single request in seconds, 0 for no limit
+        :param filechecker: FileChecker to restart the server when files change
+        :param cleanup: called in a worker before it exits
+        """
+        self.httpd = httpd
+        self.workers = workers
+        self.max_requests = max_requests
+        self.timeout = timeout
+        self.filechecker = filechecker
+        self.cleanup = cleanup
+        self.children: set[int] = set()
+        self._stopping = False
+        self._timed_out = False
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        # wait for SIGCHLD explicitly to replace workers right away
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGCHLD})
+        while not self._stopping:
+            while len(self.children) < self.workers:
+                self._spawn()
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                pid = 0
+            if pid:
+                self.children.discard(pid)
+                continue
+            if self.filechecker and not self.filechecker.filesOK():
+                self._stop_children()
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGCHLD})
+                os.execl(sys.executable, 'python', __file__, *sys.argv[1:])
+            signal.sigtimedwait({signal.SIGCHLD}, 1)
+        self._stop_children()
+
+    def _stop(self, signum, frame) -> None:
+        self._stopping = True
+
+    def _stop_children(self) -> None:
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in self.children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        self.children.clear()
+
+    def _spawn(self) -> None:
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return
+        try:
+            self._work()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(0)
+
+    def _work(self) -> None:
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGCHLD})
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGALRM, self._alarm)
+        application = self.httpd.get_app()
+
+        def timed_application(environ, start_response):
+            signal.alarm(self.timeout)
+            try:
+                # read everything while the alarm is set
+                return list(application(environ, start_response))
+            finally:
+                signal.alarm(0)
+
+        self.httpd.set_app(timed_application)
+        handled = 0
+        while not self._timed_out and (not self.max_requests or handled < self.max_requests):
+            self.httpd.handle_request()
+            handled += 1
+        if self.cleanup:
+            self.cleanup()
+
+    def _alarm(self, signum, frame) -> NoReturn:
+        # the worker may be left in a bad state, so replace it afterwards
+        self._timed_out = True
+        raise RequestTimeout(f"Request took longer than {self.timeout}s")
+
+
 def filter_url(url, non_default_args):
     if len(url) == 0:
         return ''
@@ -116,10 +246,460 @@ class ThrowingArgumentParser(argparse.ArgumentParser):
 boxes.ArgumentParser = ThrowingArgumentParser  # type: ignore
 
 
+# Limit for the estimated size of a drawing (in bytes)
+DEFAULT_MAX_MEMORY = boxes.argparseMemorySize("8M")
+# Limit for the size of the rendered files kept in memory (in bytes)
+DEFAULT_CACHE_SIZE = boxes.argparseMemorySize("64M")
+# Limit for the size of the rendered files kept in the cache directory (in bytes)
+DEFAULT_CACHE_DIR_SIZE = boxes.argparseMemorySize("256M")
+# Limit for the size of the generated HTML pages kept in memory (in bytes)
+DEFAULT_PAGE_CACHE_SIZE = boxes.argparseMemorySize("32M")
+# Limits for the time spent drawing (in seconds)
+DEFAULT_MAX_TIME = 20.0
+DEFAULT_MAX_CPU_TIME = 10.0
+# Seconds clients and proxies may keep rendered files without asking again
+DEFAULT_MAX_AGE = 3600
+# Content types worth compressing, when the client accepts it
+COMPRESSIBLE_TYPES = {"text/html", "text/plain", "image/svg+xml", "image/vnd.dxf",
+                      "application/postscript", "application/lbrn2",
+                      "application/vnd.hp-hpgl", "application/json"}
+# Threads rendering jobs submitted to /jobs/ and the limit of pending jobs
+DEFAULT_JOB_WORKERS = 2
+DEFAULT_MAX_JOBS = 64
+# Limit for waiting for a job to finish in a status request (in seconds)
+MAX_JOB_WAIT = 30.0
+# Limit for the arguments of a job sent as form data (in bytes)
+MAX_JOB_FORM_SIZE = 64 * 1024
+
+
+def code_version() -> str:
+    """Hash over the source files so cached results do not outlive code changes
+
+    Uses the content as edits and checkouts do not reliably change the
+    size or the modification time. Meant to be called once at start up.
+    """
+    h = hashlib.sha256()
+    base = os.path.dirname(boxes.__file__)
+    for path in sorted(glob.glob(os.path.join(base, "**", "*.py"), recursive=True)):
+        h.update(os.path.relpath(path, base).encode() + b"\0")
+        with open(path, "rb") as f:
+            h.update(hashlib.sha256(f.read()).digest())
+    return h.hexdigest()
+
+
+class RenderCache:
+    """Rendered files with their HTTP headers, least recently used are dropped first
+
+    The output embeds the URL it was requested with, so the URL is part of
+    the key in addition to the arguments.
+    """
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, directory=None, max_disk_size=DEFAULT_CACHE_DIR_SIZE) -> None:
+        """
+        :param max_size: limit for the size of the data kept in memory in bytes, None or 0 disables caching
+        :param directory: also store the files there to keep them across restarts
+        :param max_disk_size: limit for the size of the files in directory in bytes, None or 0 for no limit
+        """
+        self.max_size = max_size or 0
+        self.directory = directory
+        self.max_disk_size = max_disk_size
+        self.disk_size = 0
+        self.disk_evictions = 0
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[bytes, list]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._version = code_version()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._trim_disk()
+
+    def key(self, name, non_default_args, fmt, lang_name, url, render) -> str:
+        args = sorted((k, repr(v)) for k, v in non_default_args.items())
+        return hashlib.sha256(repr(
+            (self._version, name, args, fmt, lang_name, url, render)).encode()).hexdigest()
+
+    def get(self, key):
+        """Return (data, headers) or None"""
+        if not self.max_size:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry
+        if self.directory:
+            try:
+                with open(os.path.join(self.directory, key + ".json")) as f:
+                    headers = [tuple(h) for h in json.load(f)]
+                with open(os.path.join(self.directory, key), "rb") as f:
+                    entry = (f.read(), headers)
+                # the modification time tells _trim_disk() when it was used last
+                os.utime(os.path.join(self.directory, key))
+            except (OSError, ValueError):
+                entry = None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self._add(key, entry)
+        return entry
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": self.size,
+                "max_size": self.max_size,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / max(self.hits + self.misses, 1),
+                "disk_size": self.disk_size,
+                "max_disk_size": self.max_disk_size,
+                "disk_evictions": self.disk_evictions,
+            }
+
+    def put(self, key, data, headers) -> None:
+        if not self.max_size or len(data) > self.max_size:
+            return
+        entry = (data, headers)
+        self._add(key, entry)
+        if self.directory:
+            # write to temporary files first so readers never see partial files
+            path = os.path.join(self.directory, key)
+            try:
+                for fn, content, mode in ((path, data, "wb"),
+                                          (path + ".json", json.dumps(headers), "w")):
+                    tmp = f"{fn}.{os.getpid()}.{threading.get_ident()}.tmp"
+                    with open(tmp, mode) as f:
+                        f.write(content)
+                    size = os.stat(tmp).st_size
+                    with self._disk_lock:
+                        # a file written before for the same key is replaced
+                        try:
+                            size -= os.stat(fn).st_size
+                        except FileNotFoundError:
+                            pass
+                        os.replace(tmp, fn)
+                        self.disk_size += size
+            except OSError:
+                traceback.print_exc()
+            with self._disk_lock:
+                trim = self.max_disk_size and self.disk_size > self.max_disk_size
+            if trim:
+                self._trim_disk()
+
+    def _trim_disk(self) -> None:
+        """Remove the least recently used files until the directory is below 90% of its limit
+
+        Looks at the directory itself as other worker processes write
+        there, too.
+        """
+        with self._disk_lock:
+            entries: dict[str, list] = {}
+            for fn in os.listdir(self.directory):
+                if fn.endswith(".tmp"):
+                    continue
+                key = fn[:-len(".json")] if fn.endswith(".json") else fn
+                try:
+                    st = os.stat(os.path.join(self.directory, fn))
+                except OSError:
+                    continue
+                entry = entries.setdefault(key, [0.0, 0])
+                entry[0] = max(entry[0], st.st_mtime)
+                entry[1] += st.st_size
+            size = sum(size for _mtime, size in entries.values())
+            for key, (_mtime, entry_size) in sorted(entries.items(), key=lambda e: e[1][0]):
+                if not self.max_disk_size or size <= self.max_disk_size * 0.9:
+                    break
+                for fn in (key, key + ".json"):
+                    try:
+                        os.remove(os.path.join(self.directory, fn))
+                    except OSError:
+                        pass
+                size -= entry_size
+                self.disk_evictions += 1
+            self.disk_size = size
+
+    def _add(self, key, entry) -> None:
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self._entries[key] = entry
+            self.size += len(entry[0])
+            while self.size > self.max_size:
+                _key, (data, _headers) = self._entries.popitem(last=False)
+                self.size -= len(data)
+
+
+class RenderJobs:
+    """Render files in the background, so clients can poll instead of waiting
+
+    A fixed number of threads works through the queued jobs. Finished jobs
+    are kept for some time so the file can be downloaded. With a directory
+    the state and the files are stored there, so all worker processes of a
+    PreforkServer can answer for every job.
+    """
+
+    unfinished = ("queued", "running")
+
+    def __init__(self, workers=2, max_jobs=64, keep=600, directory=None) -> None:
+        """
+        :param workers: number of threads rendering jobs
+        :param max_jobs: limit for the number of queued and running jobs
+        :param keep: seconds finished jobs are kept
+        :param directory: store the state and the files there
+        """
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.keep = keep
+        self.directory = directory
+        self.pending = 0
+        self._jobs: dict[str, dict] = {}
+        self._results: dict[str, bytes] = {}
+        self._queue: queue.Queue = queue.Queue()
+        self._threads: list[threading.Thread] = []
+        self._cond = threading.Condition()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def submit(self, generator, func):
+        """Queue func which returns (data, http_headers)
+
+        Returns the state of the new job or None if too many jobs are pending.
+        """
+        with self._cond:
+            self._expire()
+            if self.pending >= self.max_jobs:
+                return None
+            self.pending += 1
+            state = {"id": uuid.uuid4().hex, "generator": generator,
+                     "status": "queued", "created": time.time()}
+            self._jobs[state["id"]] = state
+            # started here and not in __init__ as threads do not survive fork()
+            if len(self._threads) < self.workers:
+                t = threading.Thread(target=self._run, daemon=True)
+                self._threads.append(t)
+                t.start()
+        self._write(state)
+        self._queue.put((state["id"], func))
+        return self._public(state)
+
+    def status(self, job_id, wait=0.0):
+        """Return the state of the job or None if it is not known
+
+        :param wait: seconds to wait for the job to finish
+        """
+        deadline = time.monotonic() + wait
+        with self._cond:
+            state = self._jobs.get(job_id)
+            if state is not None:
+                while state["status"] in self.unfinished:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                return self._public(state)
+        # run by another process
+        while True:
+            state = self._read(job_id)
+            if (state is None or state["status"] not in self.unfinished or
+                    time.monotonic() >= deadline):
+                return self._public(state) if state else None
+            time.sleep(0.1)
+
+    def result(self, job_id):
+        """Return (data, http_headers) of a finished job or None"""
+        with self._cond:
+            state = self._jobs.get(job_id)
+            if state is not None and job_id in self._results:
+                return self._results[job_id], state["headers"]
+        state = self._read(job_id)
+        if state is None or state["status"] != "done":
+            return None
+        try:
+            with open(os.path.join(self.directory, job_id + ".data"), "rb") as f:
+                return f.read(), [tuple(h) for h in state["headers"]]
+        except OSError:
+            return None
+
+    def shutdown(self) -> None:
+        """Finish all queued jobs and stop the threads"""
+        for t in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads.clear()
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            job_id, func = item
+            self._update(job_id, status="running", started=time.time())
+            try:
+                data, headers = func()
+            except Exception as e:
+                if not isinstance(e, ValueError):
+                    print("Exception during rendering:")
+                    traceback.print_exc()
+                self._update(job_id, status="failed", error=str(e))
+                continue
+            if self.directory:
+                try:
+                    self._replace(job_id + ".data", data, "wb")
+                except OSError:
+                    traceback.print_exc()
+                    self._update(job_id, status="failed", error="Could not store the file")
+                    continue
+            else:
+                with self._cond:
+                    self._results[job_id] = data
+            self._update(job_id, status="done", size=len(data), headers=headers)
+
+    def _update(self, job_id, **kw) -> None:
+        with self._cond:
+            state = self._jobs[job_id]
+            state.update(kw)
+            if state["status"] not in self.unfinished:
+                state["finished"] = time.time()
+                self.pending -= 1
+            # written before waking up waiters, which may read it right away
+            self._write(state)
+            self._cond.notify_all()
+
+    def _expire(self) -> None:
+        """Forget about old finished jobs, expects the lock to be held"""
+        limit = time.time() - self.keep
+        for job_id, state in list(self._jobs.items()):
+            if state.get("finished", limit) < limit:
+                del self._jobs[job_id]
+                self._results.pop(job_id, None)
+        if self.directory:
+            for fn in os.listdir(self.directory):
+                path = os.path.join(self.directory, fn)
+                try:
+                    if fn.endswith(".tmp"):
+                        # left over by a process that died while writing
+                        if os.stat(path).st_mtime < limit:
+                            os.remove(path)
+                    elif fn.endswith(".json"):
+                        # by the time the job finished, not when it was queued
+                        state = self._read(fn[:-len(".json")])
+                        if state is not None and state.get("finished", limit) < limit:
+                            data = path[:-len(".json")] + ".data"
+                            if os.path.exists(data):
+                                os.remove(data)
+                            os.remove(path)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _public(state):
+        return {k: v for k, v in state.items() if k != "headers"}
+
+    def _read(self, job_id):
+        if not self.directory or not re.fullmatch(r"[0-9a-f]{32}", job_id):
+            return None
+        try:
+            with open(os.path.join(self.directory, job_id + ".json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, state) -> None:
+        if not self.directory:
+            return
+        try:
+            self._replace(state["id"] + ".json", json.dumps(state), "w")
+        except OSError:
+            traceback.print_exc()
+
+    def _replace(self, fn, content, mode) -> None:
+        # write to a temporary file first so readers never see partial files
+        path = os.path.join(self.directory, fn)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, mode) as f:
+            f.write(content)
+        os.replace(tmp, path)
+
+
+class PageCache:
+    """Generated pages, least recently used are dropped first
+
+    Hits are counted per entry and in total for the statistics.
+    """
+
+    def __init__(self, max_size=DEFAULT_PAGE_CACHE_SIZE) -> None:
+        """
+        :param max_size: limit for the size of the pages kept in bytes, None or 0 disables caching
+        """
+        self.max_size = max_size or 0
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> [body, size, hits]
+        self._entries: OrderedDict[Any, list] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the body as list of bytes or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry[2] += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, body) -> None:
+        size = sum(len(b) for b in body)
+        if size > self.max_size:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = [body, size, 0]
+            self.size += size
+            while self.size > self.max_size:
+                _key, (_body, old_size, _hits) = self._entries.popitem(last=False)
+                self.size -= old_size
+                self.evictions += 1
+
+    def stats(self, top=10) -> dict:
+        with self._lock:
+            entries = sorted(self._entries.items(), key=lambda e: e[1][2], reverse=True)[:top]
+            return {
+                "size": self.size,
+                "max_size": self.max_size,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / max(self.hits + self.misses, 1),
+                "evictions": self.evictions,
+                "top": [{"key": repr(key), "size": size, "hits": hits}
+                        for key, (_body, size, hits) in entries],
+            }
+
+
 class BServer:
     lang_re = re.compile(r"([a-z]{2,3}(-[-a-zA-Z0-9]*)?)\s*(;\s*q=(\d\.?\d*))?")
 
-    def __init__(self, url_prefix="", static_url="static", static_path="../static/", legal_url="") -> None:
+    def __init__(self, url_prefix="", static_url="static", static_path="../static/", legal_url="", max_memory=DEFAULT_MAX_MEMORY,
+                 cache_size=DEFAULT_CACHE_SIZE, cache_dir=None, cache_dir_size=DEFAULT_CACHE_DIR_SIZE,
+                 max_time=DEFAULT_MAX_TIME, max_cpu_time=DEFAULT_MAX_CPU_TIME,
+                 job_workers=DEFAULT_JOB_WORKERS, max_jobs=DEFAULT_MAX_JOBS, job_dir=None,
+                 max_age=DEFAULT_MAX_AGE, page_cache_size=DEFAULT_PAGE_CACHE_SIZE) -> None:
         self.boxes = {b.__name__: b for b in boxes.generators.getAllBoxGenerators().values() if b.webinterface}
         self.groups = boxes.generators.ui_groups
         self.groups_by_name = boxes.generators.ui_groups_by_name
@@ -128,6 +708,8 @@ class BServer:
             box.UI = "web"
             self.groups_by_name.get(box.ui_group,
                                     self.groups_by_name["Misc"]).add(box)
+            # build the argument parsers now, shared by the worker processes
+            box.fromPrototype()
 
         if os.path.isabs(static_path):
             self.staticdir = static_path
@@ -136,10 +718,53 @@ class BServer:
             if not os.path.isdir(self.staticdir):
                 self.staticdir = os.path.join(os.path.dirname(__file__), '..', '../static/')
         self._languages = None
-        self._cache: dict[Any, Any] = {}
+        self._cache = PageCache(page_cache_size)
+        # cleared while warmup() runs
+        self.ready = threading.Event()
+        self.ready.set()
         self.url_prefix = url_prefix
         self.static_url = static_url
         self.legal_url = legal_url
+        self.max_memory = max_memory
+        self.max_time = max_time
+        self.max_cpu_time = max_cpu_time
+        self.max_age = max_age
+        self.render_cache = RenderCache(cache_size, cache_dir, cache_dir_size)
+        self.jobs = RenderJobs(job_workers, max_jobs, directory=job_dir)
+
+    def warmup(self, workers=4) -> None:
+        """Generate the gallery, the menu and all settings pages in all languages
+
+        Uses a pool of threads. self.ready is cleared until done. Clear it
+        before starting this in a thread to not report ready in between.
+        """
+        self.ready.clear()
+        try:
+            start = time.monotonic()
+            evictions = self._cache.evictions
+            # as requested by browsers accepting compression and by those that do not
+            encodings = [None, accepted_encoding("br, gzip")]
+
+            def warm(language):
+                lang = self.getLanguage([f"language={language}"] if language else [], "")
+                lang_name = lang.info().get('language', None)
+                for encoding in encodings:
+                    self.cachedPage(("Gallery", lang_name), encoding, lambda: self.genPageGallery(lang))
+                    self.cachedPage(lang_name, encoding, lambda: self.genPageMenu(lang))
+                    for name, box_cls in self.boxes.items():
+                        self.args2html_cached(name, box_cls.fromPrototype(), lang, "./" + name,
+                                              encoding=encoding)
+
+            with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+                for _ in pool.map(warm, [None] + self.getLanguages()):
+                    pass
+            stats = self._cache.stats()
+            print(f"Warm up done in {time.monotonic() - start:.1f}s: "
+                  f"{stats['entries']} pages, {stats['size'] / 2**20:.1f}MB")
+            if stats["evictions"] > evictions:
+                print("Not all pages fit into the page cache, consider raising --page_cache_size")
+        finally:
+            self.ready.set()
 
     def getLanguages(self, domain=None, localedir=None):
         if self._languages is not None:
@@ -216,14 +841,43 @@ class BServer:
 
         return row % input
 
-    def args2html_cached(self, name, box, lang, action="", defaults={}):
+    def args2html_cached(self, name, box, lang, action="", defaults={}, encoding=None):
         if defaults == {}:
             key = (name, lang.info().get('language', None), action)
-            if key not in self._cache:
-                self._cache[key] = list(self.args2html(name, box, lang, action, defaults))
-            return self._cache[key]
-
-        return self.args2html(name, box, lang, action, defaults)
+            return self.cachedPage(key, encoding, lambda: self.args2html(name, box, lang, action, defaults))
+
+        result = self.args2html(name, box, lang, action, defaults)
+        if encoding:
+            return [compress(b"".join(result), encoding)]
+        return result
+
+    def cachedPage(self, key, encoding, generate):
+        """Return a page from the cache, generate() creates it if missing
+
+        :param encoding: compressed version to return, None for uncompressed
+        """
+        page = self._cache.get((key, encoding))
+        if page is None:
+            if encoding:
+                page = [compress(b"".join(self.cachedPage(key, None, generate)), encoding)]
+            else:
+                page = list(generate())
+            self._cache.put((key, encoding), page)
+        return page
+
+    def negotiateEncoding(self, environ, headers):
+        """Choose how to compress a response
+
+        Returns the headers to send and the encoding to use or None.
+        """
+        content_type = dict(headers).get('Content-type', '').split(";")[0].strip()
+        if content_type not in COMPRESSIBLE_TYPES:
+            return headers, None
+        headers = headers + [('Vary', 'Accept-Encoding')]
+        encoding = accepted_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding:
+            headers.append(('Content-Encoding', encoding))
+        return headers, encoding
 
     def args2html(self, name, box, lang, action="", defaults={}):
         _ = lang.gettext
@@ -544,6 +1198,103 @@ class BServer:
         f = open(path, 'rb')
         return environ['wsgi.file_wrapper'](f, 512 * 1024)
 
+    def serveJobs(self, environ, start_response):
+        """Render files in the background
+
+        POST /jobs/<generator>?<arguments> queues a job and returns its
+        state, the arguments may also be sent as form data
+        /jobs/<id>?wait=<seconds> returns the state, waiting up to the given
+        time for the job to finish
+        /jobs/<id>/file returns the file of a finished job
+        """
+        headers = [('Content-type', 'application/json'), ('X-Robots-Tag', 'noindex,nofollow')]
+
+        def reply(status, content, extra_headers=[]):
+            start_response(status, headers + extra_headers)
+            return [json.dumps(content).encode("utf-8")]
+
+        path = environ["PATH_INFO"][len("/jobs/"):].split("/")
+        method = environ.get("REQUEST_METHOD", "GET")
+        query = environ.get('QUERY_STRING', '')
+        box_cls = self.boxes.get(path[0], None)
+
+        if box_cls and len(path) == 1:
+            # not GET as prefetching browsers, crawlers and proxies repeat those
+            if method != "POST":
+                return reply("405 Method Not Allowed", {"error": "Use POST to create jobs"},
+                             [('Allow', 'POST')])
+            if environ.get("CONTENT_TYPE", "").startswith("application/x-www-form-urlencoded"):
+                try:
+                    length = int(environ.get("CONTENT_LENGTH") or 0)
+                except ValueError:
+                    length = 0
+                if length > MAX_JOB_FORM_SIZE:
+                    return reply("413 Content Too Large", {"error": "Too many arguments"})
+                body = environ["wsgi.input"].read(length).decode("utf-8", "replace")
+                query = "&".join(q for q in (query, body) if q)
+            args = [unquote_plus(arg) for arg in query.split("&")]
+            name = path[0]
+            lang = self.getLanguage(args, environ.get("HTTP_ACCEPT_LANGUAGE", ""))
+            box = box_cls.fromPrototype()
+            box.translations = lang
+            box.surface_options = {"compact": True, "max_memory": self.max_memory,
+                                   "max_time": self.max_time, "max_cpu_time": self.max_cpu_time}
+            try:
+                box.parseArgs(["--" + arg for arg in args if arg and not arg.startswith("render=")])
+            except ArgumentParserError as e:
+                return reply("400 Bad Request", {"error": str(e)})
+            # embed the URL the file can be generated with directly
+            url = self.getURL(dict(environ, PATH_INFO="/" + name))
+            key = self.renderKey(box, name, lang, url, "2")
+            state = self.jobs.submit(name, lambda: self.renderFile(box, key, "2"))
+            if state is None:
+                return reply("503 Service Unavailable", {"error": "Too many jobs queued"},
+                             [('Retry-After', '10')])
+            location = quote(self.url_prefix + environ.get('SCRIPT_NAME', '') + "/jobs/" + state["id"])
+            return reply("202 Accepted", state, [('Location', location)])
+
+        args = [unquote_plus(arg) for arg in query.split("&")]
+        if method not in ("GET", "HEAD"):
+            return reply("405 Method Not Allowed", {"error": "Use GET to query jobs"},
+                         [('Allow', 'GET, HEAD')])
+
+        if len(path) == 1:
+            wait = 0.0
+            for arg in args:
+                if arg.startswith("wait="):
+                    try:
+                        wait = min(max(float(arg[len("wait="):]), 0.0), MAX_JOB_WAIT)
+                    except ValueError:
+                        pass
+            state = self.jobs.status(path[0], wait)
+            if state is None:
+                return reply("404 Not Found", {"error": "Unknown job"})
+            return reply("200 OK", state)
+
+        if len(path) == 2 and path[1] == "file":
+            result = self.jobs.result(path[0])
+            if result is None:
+                state = self.jobs.status(path[0])
+                if state is None:
+                    return reply("404 Not Found", {"error": "Unknown job"})
+                return reply("409 Conflict", state)
+            data, http_headers = result
+            http_headers, encoding = self.negotiateEncoding(environ, http_headers)
+            if encoding:
+                data = compress(data, encoding)
+            start_response("200 OK", http_headers)
+            return [data]
+
+        return reply("404 Not Found", {"error": "Not found"})
+
+    def serveCacheStats(self, environ, start_response):
+        """Sizes and hit ratios of the caches of this process"""
+        stats = {"pages": self._cache.stats(), "files": self.render_cache.stats()}
+        start_response("200 OK", [('Content-type', 'application/json'),
+                                  ('Cache-Control', 'no-store'),
+                                  ('X-Robots-Tag', 'noindex,nofollow')])
+        return [json.dumps(stats, indent=1).encode("utf-8")]
+
     def getURL(self, environ) -> str:
         url = environ['wsgi.url_scheme'] + '://'
 
@@ -567,13 +1318,14 @@ class BServer:
         return url
 
     def serveGallery(self, environ, start_response, lang):
-        _ = lang.gettext
         lang_name = lang.info().get('language', None)
+        headers, encoding = self.negotiateEncoding(environ, [('Content-type', "text/html; charset=utf-8")])
+        start_response("200 OK", headers)
+        return self.cachedPage(("Gallery", lang_name), encoding, lambda: self.genPageGallery(lang))
 
-        start_response("200 OK", [('Content-type', "text/html; charset=utf-8")])
-
-        if ("Gallery", lang_name) in self._cache:
-            return self._cache[("Gallery", lang_name)]
+    def genPageGallery(self, lang):
+        _ = lang.gettext
+        lang_name = lang.info().get('language', None)
 
         langparam = ""
         if lang_name:
@@ -618,8 +1370,7 @@ class BServer:
 </html>
 """
                       )
-        self._cache[("Gallery", lang_name)] = [s.encode("utf-8") for s in result]
-        return self._cache[("Gallery", lang_name)]
+        return (s.encode("utf-8") for s in result)
 
     def serve(self, environ, start_response):
         # serve favicon from static for generated SVGs
@@ -627,6 +1378,16 @@ class BServer:
             environ["PATH_INFO"] = "/static/favicon.ico"
         if environ["PATH_INFO"].startswith("/static/"):
             return self.serveStatic(environ, start_response)
+        if environ["PATH_INFO"].startswith("/jobs/"):
+            return self.serveJobs(environ, start_response)
+        if environ["PATH_INFO"] == "/admin/cache":
+            return self.serveCacheStats(environ, start_response)
+        if environ["PATH_INFO"] == "/admin/ready":
+            # for load balancers, fails while warming up
+            ready = self.ready.is_set()
+            start_response("200 OK" if ready else "503 Service Unavailable",
+                           [('Content-type', 'text/plain'), ('Cache-Control', 'no-store')])
+            return [b"ready" if ready else b"warming up"]
 
         status = '200 OK'
         headers = [('Content-type', 'text/html; charset=utf-8'), ('X-XSS-Protection', '1; mode=block'), ('X-Content-Type-Options', 'nosniff'), ('x-frame-options', 'SAMEORIGIN'), ('Referrer-Policy', 'no-referrer')]
@@ -651,16 +1412,17 @@ class BServer:
 
         box_cls = self.boxes.get(name, None)
         if not box_cls:
+            headers, encoding = self.negotiateEncoding(environ, headers)
             start_response(status, headers)
 
             lang_name = lang.info().get('language', None)
-            if lang_name not in self._cache:
-                self._cache[lang_name] = list(self.genPageMenu(lang))
-            return self._cache[lang_name]
+            return self.cachedPage(lang_name, encoding, lambda: self.genPageMenu(lang))
 
-        box = box_cls()
+        box = box_cls.fromPrototype()
 
         box.translations = lang
+        box.surface_options = {"compact": True, "max_memory": self.max_memory,
+                               "max_time": self.max_time, "max_cpu_time": self.max_cpu_time}
 
         if render == "0":
             defaults = {}
@@ -669,8 +1431,9 @@ class BServer:
                 if len(kv) == 2:
                     k, v = kv
                     defaults[k] = html.escape(v, True)
+            headers, encoding = self.negotiateEncoding(environ, headers)
             start_response(status, headers)
-            return self.args2html_cached(name, box, lang, "./" + name, defaults=defaults)
+            return self.args2html_cached(name, box, lang, "./" + name, defaults=defaults, encoding=encoding)
 
         args = ["--" + arg for arg in args if not arg.startswith("render=")]
         try:
@@ -684,12 +1447,15 @@ class BServer:
                 return self.genPageError(name, e, lang)
 
         try:
-            box.metadata["url"] = self.getURL(environ)
-            box.metadata["url_short"] = filter_url(box.metadata["url"],
-                                                   box.non_default_args)
-            box.open()
-            box.render()
-            data = box.close()
+            key = self.renderKey(box, name, lang, self.getURL(environ), render)
+            # the output only depends on the key, so clients and proxies may keep it
+            cache_headers = [('Cache-Control', f'public, max-age={self.max_age}'),
+                             ('Vary', 'Accept-Language')]
+            etag = etag_match(environ.get('HTTP_IF_NONE_MATCH', ''), key)
+            if etag:
+                start_response("304 Not Modified", cache_headers + [('ETag', etag), ('Vary', 'Accept-Encoding')])
+                return []
+            data, http_headers = self.renderFile(box, key, render)
         except Exception as e:
             if not isinstance(e, ValueError):
                 print("Exception during rendering:")
@@ -701,6 +1467,46 @@ class BServer:
                 start_response("500 Internal Server Error", headers)
                 return self.genPageError(name, e, lang)
 
+        http_headers, encoding = self.negotiateEncoding(environ, http_headers + cache_headers)
+        etag = key
+        if encoding:
+            # compressed versions are kept in the render cache, too
+            etag = f"{key}.{encoding}"
+            cached = self.render_cache.get(etag)
+            if cached is not None:
+                data = cached[0]
+            else:
+                data = compress(data, encoding)
+                self.render_cache.put(etag, data, [])
+        start_response(status, http_headers + [('ETag', f'"{etag}"')])
+        return [data]
+
+    def renderKey(self, box, name, lang, url, render="1") -> str:
+        """Prepare a box with its arguments already parsed for renderFile()
+
+        Returns the key identifying the output, see RenderCache.key().
+        """
+        box.metadata["url"] = url
+        box.metadata["url_short"] = filter_url(url, box.non_default_args)
+        # no creation date, the same key has to give the same file
+        box.metadata["reproducible"] = True
+        return self.render_cache.key(name, box.non_default_args, box.format,
+                                     lang.info().get('language', None),
+                                     url, render)
+
+    def renderFile(self, box, cache_key, render="1"):
+        """Render a box prepared by renderKey()
+
+        Returns (data, http_headers), using the render cache if possible.
+        """
+        cached = self.render_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        box.open()
+        box.render()
+        data = box.close()
+
         http_headers = box.formats.http_headers.get(box.format, [('Content-type', 'application/unknown; charset=utf-8')])[:]
         # Prevent crawlers.
         http_headers.append(('X-Robots-Tag', 'noindex,nofollow'))
@@ -709,18 +1515,60 @@ class BServer:
             http_headers = [('Content-type', 'image/png')]
             http_headers.append(('X-Robots-Tag', 'noindex,nofollow'))
             qr_format = "png"
-            fn = box.__class__.__name__
-            start_response(status, http_headers)
             qrcode = get_qrcode(box.metadata["url_short"], qr_format)
-            return (qrcode,)
+            self.render_cache.put(cache_key, qrcode, http_headers)
+            return qrcode, http_headers
 
         if box.format != "svg" or render == "2":
             extension = box.format
             if extension == "svg_Ponoko":
                 extension = "svg"
             http_headers.append(('Content-Disposition', f'attachment; filename="{box.__class__.__name__}.{extension}"'))
-        start_response(status, http_headers)
-        return environ['wsgi.file_wrapper'](data, 512 * 1024)
+        self.render_cache.put(cache_key, data.getvalue(), http_headers)
+        return data.getvalue(), http_headers
+
+
+def etag_match(if_none_match, key):
+    """Return the tag of the If-None-Match header matching key or None
+
+    Tags of compressed versions have the encoding appended to the key.
+    """
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return f'"{key}"'
+        tag = tag.removeprefix("W/")
+        if tag.strip('"').split(".")[0] == key:
+            return tag
+    return None
+
+
+def accepted_encoding(accept_encoding):
+    """Return the compression to use for an Accept-Encoding header or None"""
+    quality = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        q = 1.0
+        m = re.search(r"q=([0-9.]+)", params)
+        if m:
+            try:
+                q = float(m.group(1))
+            except ValueError:
+                q = 0.0
+        quality[name.strip().lower()] = q
+    best = None
+    for encoding in ("br", "gzip") if brotli else ("gzip",):
+        q = quality.get(encoding, quality.get("*", 0.0))
+        if q > 0 and (best is None or q > best[0]):
+            best = (q, encoding)
+    return best[1] if best else None
+
+
+def compress(data, encoding) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=6)
+    # no time stamp so the same data gives the same bytes
+    return gzip.compress(data, compresslevel=6, mtime=0)
 
 
 def get_qrcode(url, format):
@@ -745,20 +1593,77 @@ def main() -> None:
                         help="location of static content on disk")
     parser.add_argument("--legal_url", default="",
                         help="URL of legal web page")
+    parser.add_argument("--max_memory", type=boxes.argparseMemorySize, default=DEFAULT_MAX_MEMORY,
+                        help="limit for the size of a drawing, e.g. 32M, 0 for no limit (default: 8M)")
+    parser.add_argument("--max_time", type=float, default=DEFAULT_MAX_TIME,
+                        help="seconds a drawing may take, 0 for no limit (default: 20)")
+    parser.add_argument("--max_cpu_time", type=float, default=DEFAULT_MAX_CPU_TIME,
+                        help="seconds of CPU time a drawing may take, 0 for no limit (default: 10)")
+    parser.add_argument("--cache_size", type=boxes.argparseMemorySize, default=DEFAULT_CACHE_SIZE,
+                        help="memory for caching rendered files, 0 to disable (default: 64M)")
+    parser.add_argument("--page_cache_size", type=boxes.argparseMemorySize, default=DEFAULT_PAGE_CACHE_SIZE,
+                        help="memory for caching generated pages, 0 to disable (default: 32M)")
+    parser.add_argument("--cache_dir", default=None,
+                        help="directory to also keep rendered files in across restarts")
+    parser.add_argument("--cache_dir_size", type=boxes.argparseMemorySize, default=DEFAULT_CACHE_DIR_SIZE,
+                        help="limit for the size of the files in --cache_dir, 0 for no limit (default: 256M)")
+    parser.add_argument("--max_age", type=int, default=DEFAULT_MAX_AGE,
+                        help="seconds browsers and proxies may cache rendered files (default: 3600)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="number of worker processes, 0 to serve from a single process (default: 0)")
+    parser.add_argument("--max_requests", type=int, default=1000,
+                        help="requests before a worker process is replaced, 0 for no limit (default: 1000)")
+    parser.add_argument("--timeout", type=int, default=60,
+                        help="seconds a worker process may spend on a request, 0 for no limit (default: 60)")
+    parser.add_argument("--warmup", action="store_true", default=False,
+                        help="generate all pages in all languages at start up, /admin/ready fails until done")
+    parser.add_argument("--job_workers", type=int, default=DEFAULT_JOB_WORKERS,
+                        help="threads rendering jobs submitted to /jobs/ (default: 2)")
+    parser.add_argument("--max_jobs", type=int, default=DEFAULT_MAX_JOBS,
+                        help="limit for jobs waiting to be rendered (default: 64)")
+    parser.add_argument("--job_dir", default=None,
+                        help="directory to keep jobs in, needed to share them between worker processes (default: a temporary directory if --workers is used)")
     args = parser.parse_args()
+    if args.workers and not hasattr(os, "fork"):
+        parser.error("--workers is not supported on this platform")
+    job_dir = args.job_dir
+    if args.workers and not job_dir:
+        job_dir = tempfile.mkdtemp(prefix="boxes-jobs-")
 
     boxserver = BServer(url_prefix=args.url_prefix, static_url=args.static_url,
-                        static_path=args.static_path)
+                        static_path=args.static_path, max_memory=args.max_memory,
+                        cache_size=args.cache_size, cache_dir=args.cache_dir,
+                        cache_dir_size=args.cache_dir_size,
+                        max_time=args.max_time or None, max_cpu_time=args.max_cpu_time or None,
+                        job_workers=args.job_workers, max_jobs=args.max_jobs, job_dir=job_dir,
+                        max_age=args.max_age, page_cache_size=args.page_cache_size)
 
     fc = FileChecker()
-    fc.start()
 
-    httpd = make_server(args.host, args.port, boxserver.serve)
     print(f"BoxesServer serving on http://{args.host if args.host else '*'}:{args.port}/...")
-    try:
-        httpd.serve_forever()
-    except KeyboardInterrupt:
-        fc.stop()
+    if args.workers:
+        if args.warmup:
+            # before forking so the workers share the pages
+            boxserver.warmup()
+        # no threads before forking, the parent checks the files itself
+        # workers handle one request at a time so the timeout can interrupt it
+        httpd = make_server(args.host, args.port, boxserver.serve)
+        PreforkServer(httpd, args.workers, args.max_requests, args.timeout, fc,
+                      boxserver.jobs.shutdown).run()
+        if not args.job_dir:
+            shutil.rmtree(job_dir, ignore_errors=True)
+    else:
+        # threads so waiting for jobs does not block other requests
+        httpd = make_server(args.host, args.port, boxserver.serve, server_class=ThreadingWSGIServer)
+        if args.warmup:
+            # not ready before the thread even started
+            boxserver.ready.clear()
+            threading.Thread(target=boxserver.warmup, daemon=True).start()
+        fc.start()
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            fc.stop()
     httpd.server_close()
     print("BoxesServer stops.")
 
@@ -767,5 +1672,16 @@ if __name__ == "__main__":
     main()
 else:
     static_url = os.environ.get('STATIC_URL', 'https://florianfesti.github.io/boxes/static')
-    boxserver = BServer(static_url=static_url)
+    max_memory = boxes.argparseMemorySize(os.environ.get('MAX_MEMORY', '8M'))
+    cache_size = boxes.argparseMemorySize(os.environ.get('CACHE_SIZE', '64M'))
+    max_time = float(os.environ.get('MAX_TIME', DEFAULT_MAX_TIME)) or None
+    max_cpu_time = float(os.environ.get('MAX_CPU_TIME', DEFAULT_MAX_CPU_TIME)) or None
+    boxserver = BServer(static_url=static_url, max_memory=max_memory,
+                        cache_size=cache_size, cache_dir=os.environ.get('CACHE_DIR'),
+                        cache_dir_size=boxes.argparseMemorySize(os.environ.get('CACHE_DIR_SIZE', '256M')),
+                        max_time=max_time, max_cpu_time=max_cpu_time,
+                        job_workers=int(os.environ.get('JOB_WORKERS', DEFAULT_JOB_WORKERS)),
+                        job_dir=os.environ.get('JOB_DIR'),
+                        max_age=int(os.environ.get('MAX_AGE', DEFAULT_MAX_AGE)),
+                        page_cache_size=boxes.argparseMemorySize(os.environ.get('PAGE_CACHE_SIZE', '32M')))
     application = boxserver.serve
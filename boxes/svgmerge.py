@@ -9,9 +9,71 @@ import rectpack
 from rectpack import newPacker, PackingBin
 from svgpathtools import parse_path
 
+from boxes.drawing import curve_extrema
+
 SVG_NS = "http://www.w3.org/2000/svg"
 ET.register_namespace("", SVG_NS)
 
+# path data as written by SVGSurface: absolute M, L, H, V, C and Z only
+SIMPLE_PATH_RE = re.compile(r"[MLHVCZ0-9eE.,+\-\s]*")
+PATH_COMMAND_RE = re.compile(r"([MLHVCZ])")
+PATH_ARGS = {"M": 2, "L": 2, "H": 1, "V": 1, "C": 6, "Z": 0}
+
+
+def simple_path_points(d):
+    """End points and curves of path data as written by SVGSurface
+
+    Returns the x and y coordinates of the end points and the cubic
+    Bézier curves as (x0, y0, x1, y1, x2, y2, x3, y3). H and V only add
+    the coordinate they change. Returns None for other path data.
+    """
+    if not SIMPLE_PATH_RE.fullmatch(d):
+        return None
+    parts = PATH_COMMAND_RE.split(d)
+    if parts[0].strip() or len(parts) < 3 or parts[1] != "M":
+        return None
+    xs = []
+    ys = []
+    curves = []
+    x = y = x0 = y0 = 0.0
+    for cmd, args in zip(parts[1::2], parts[2::2]):
+        try:
+            values = [float(v) for v in args.replace(",", " ").split()]
+        except ValueError:
+            # numbers without separator
+            return None
+        if cmd == "Z":
+            if values:
+                return None
+            # back at the start point, which is already added
+            x, y = x0, y0
+            continue
+        if not values or len(values) % PATH_ARGS[cmd]:
+            return None
+        if cmd == "H":
+            xs.extend(values)
+            x = values[-1]
+        elif cmd == "V":
+            ys.extend(values)
+            y = values[-1]
+        elif cmd == "C":
+            for i in range(0, len(values), 6):
+                curves.append((x, y, *values[i:i+6]))
+                x, y = values[i+4:i+6]
+            xs.extend(values[4::6])
+            ys.extend(values[5::6])
+        else:
+            # further pairs after M are lines
+            xs.extend(values[0::2])
+            ys.extend(values[1::2])
+            if cmd == "M":
+                x0, y0 = values[0:2]
+            x, y = values[-2:]
+    if not xs or not ys:
+        return None
+    return xs, ys, curves
+
+
 PACK_ALGO_CHOICES = (
     "MaxRectsBl",
     "MaxRectsBssf",
@@ -48,6 +110,7 @@ class SvgMerge:
         self.args = None
         self.non_default_args = {}
         self.output = None
+        self.cuts = []
         self.argparser = argparse.ArgumentParser()
         self.argparser.add_argument("cuts", nargs="+", help="Input cut files")
         self.argparser.add_argument("--rotation", default=False, action="store_true")
@@ -87,6 +150,7 @@ class SvgMerge:
             max_x = max(max_x, *x_vals)
             max_y = max(max_y, *y_vals)
 
+        curves = []
         for elem in group.iter():
             tag = elem.tag.split("}")[-1]  # Remove namespace
             if tag == "rect":
@@ -122,6 +186,12 @@ class SvgMerge:
                     update_bbox(xs, ys)
             elif tag == "path":
                 d = elem.attrib.get("d", "")
+                points = simple_path_points(d)
+                if points is not None:
+                    # extrema of all curves are computed at once below
+                    update_bbox(points[0], points[1])
+                    curves.extend(points[2])
+                    continue
                 try:
                     path = parse_path(d)
                     box = path.bbox()  # (min_x, max_x, min_y, max_y)
@@ -129,24 +199,51 @@ class SvgMerge:
                 except Exception as e:
                     print(f"Warning: Failed to parse path in group. Error: {e}")
 
+        if curves:
+            xs, ys = curve_extrema(curves, min_x, max_x, min_y, max_y)
+            if xs:
+                update_bbox(xs, [min_y])
+            if ys:
+                update_bbox([min_x], ys)
+
         # Fallback if nothing was found
         if min_x == float("inf"):
             raise ValueError
         return [min_x, min_y, max_x, max_y]
 
     @staticmethod
-    def extract_elements(svg_files):
+    def extract_elements(svg_files, counts=None):
         """
         Extract all group elements from the SVG
+
+        counts maps files to the number of copies needed. The copies
+        share the parsed groups.
         """
         elements = []
         for file in svg_files:
             groups, tree = SvgMerge.parse_svg_groups(file)
-            for g in groups:
-                bbox = SvgMerge.get_bbox_of_group(g)
-                width = bbox[2] - bbox[0]
-                height = bbox[3] - bbox[1]
-                style = g.attrib.get("style", '')
+            count = counts.get(file, 1) if counts else 1
+            elements.extend(SvgMerge.group_elements(
+                [(g, SvgMerge.get_bbox_of_group(g)) for g in groups],
+                getattr(file, "name", file), count))
+        return elements
+
+    @staticmethod
+    def group_elements(groups, source_file, count=1):
+        """
+        Elements to pack for groups with known bounding boxes
+
+        groups is a list of (group, bbox) with bbox as [min_x, min_y, max_x, max_y]
+        or Extents, e.g. from SVGSurface.part_groups().
+        """
+        elements = []
+        for g, bbox in groups:
+            if not isinstance(bbox, list):
+                bbox = [bbox.xmin, bbox.ymin, bbox.xmax, bbox.ymax]
+            width = bbox[2] - bbox[0]
+            height = bbox[3] - bbox[1]
+            style = g.attrib.get("style", '')
+            for _ in range(count):
                 elements.append({
                     'group': g,
                     'bbox': bbox,
@@ -154,7 +251,7 @@ class SvgMerge:
                     'height': height,
                     'style': style,
                     'id': str(uuid.uuid4()),
-                    'source_file': file
+                    'source_file': source_file
                 })
         return elements
 
@@ -304,7 +401,7 @@ class SvgMerge:
             if value != default:
                 self.non_default_args[key] = value
 
-    def render(self, files):
+    def render(self, files, counts=None):
         if self.args is None:
             raise RuntimeError("parseArgs must be called first")
 
@@ -317,7 +414,7 @@ class SvgMerge:
             margin_px = int( (self.margin / 25.4) * 96)
 
             logging.info("Merging %s files", len(files))
-            elements = SvgMerge.extract_elements(list(files))
+            elements = SvgMerge.extract_elements(list(files), counts)
             for element in elements:
                 if element['width'] > self.panel_width or element['height'] > self.panel_height:
                     logging.warning("Element in %s is larger than panel width and will not be included in merged output", element['source_file'])
@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import datetime
+import io
+import re
+import sys
+from pathlib import Path
+
+import pytest
+
+try:
+    import boxes
+except ImportError:
+    sys.path.append(Path(__file__).resolve().parent.parent.__str__())
+    import boxes
+
+import boxes.generators
+from boxes.Color import Color
+from boxes.drawing import SVGSurface, open_output
+from boxes.formats import Formats
+
+generators_by_name = {b.__name__: b for b in boxes.generators.getAllBoxGenerators().values()}
+
+
+def render(name: str, fmt: str, args=()) -> bytes:
+    box = generators_by_name[name]()
+    box.parseArgs([f"--format={fmt}", *args])
+    box.metadata["reproducible"] = True
+    box.open()
+    box.render()
+    return box.close().getvalue()
+
+
+class TestFormats:
+    """All formats are written natively, no external converters are needed."""
+
+    @pytest.mark.parametrize("fmt", Formats().getFormats())
+    def test_render(self, fmt) -> None:
+        assert len(render("ABox", fmt)) > 100
+
+    def test_unknown(self) -> None:
+        with pytest.raises(ValueError):
+            Formats().convert(io.BytesIO(), "eps")
+
+    def test_output(self, tmp_path) -> None:
+        fn = tmp_path / "out.svg"
+        Formats().convert(io.BytesIO(b"data"), "svg", str(fn))
+        assert fn.read_bytes() == b"data"
+
+
+class TestOutput:
+    """Files are only replaced by complete output."""
+
+    def test_close(self, tmp_path) -> None:
+        fn = tmp_path / "box.svg"
+        box = generators_by_name["ABox"]()
+        box.parseArgs([])
+        box.open()
+        box.render()
+        assert box.close(str(fn)) == str(fn)
+        assert fn.read_bytes().rstrip().endswith(b"</svg>")
+        assert [p.name for p in tmp_path.iterdir()] == ["box.svg"]
+
+    def test_failure(self, tmp_path, monkeypatch) -> None:
+        fn = tmp_path / "box.svg"
+        fn.write_bytes(b"previous")
+
+        def broken(self, part, inner_corners="loop"):
+            raise RuntimeError("broken")
+
+        monkeypatch.setattr(SVGSurface, "_part_elements", broken)
+        box = generators_by_name["ABox"]()
+        box.parseArgs([])
+        box.open()
+        box.render()
+        with pytest.raises(RuntimeError):
+            box.close(str(fn))
+        assert fn.read_bytes() == b"previous"
+        assert [p.name for p in tmp_path.iterdir()] == ["box.svg"]
+
+    def test_symlink(self, tmp_path) -> None:
+        target = tmp_path / "target.svg"
+        target.write_bytes(b"previous")
+        link = tmp_path / "link.svg"
+        link.symlink_to(target)
+        with open_output(str(link)) as f:
+            f.write(b"new")
+        assert link.is_symlink()
+        assert target.read_bytes() == b"new"
+
+
+class TestDXF:
+    """DXFSurface writes R12 files other programs can read."""
+
+    @pytest.mark.parametrize("name", ["ABox", "BurnTest", "Gears"])
+    def test_audit(self, name) -> None:
+        ezdxf_recover = pytest.importorskip("ezdxf.recover")
+        data = render(name, "dxf")
+        doc, auditor = ezdxf_recover.read(io.BytesIO(data))
+        assert doc.dxfversion == "AC1009"
+        assert not auditor.has_errors, [str(e) for e in auditor.errors]
+        assert not auditor.fixes, [str(f) for f in auditor.fixes]
+        assert len(doc.modelspace()) > 0
+
+    def test_r12_header(self) -> None:
+        data = render("ABox", "dxf")
+        # added in R14, not allowed in R12 files
+        assert b"$INSUNITS" not in data
+        assert b"$MEASUREMENT" not in data
+
+
+class TestPDF:
+    """PDFSurface writes a single page PDF."""
+
+    @pytest.mark.parametrize("name", ["ABox", "BurnTest", "Gears"])
+    def test_parse(self, name) -> None:
+        pypdf = pytest.importorskip("pypdf")
+        reader = pypdf.PdfReader(io.BytesIO(render(name, "pdf")), strict=True)
+        assert len(reader.pages) == 1
+        page = reader.pages[0]
+        assert len(page.get_contents().get_data()) > 100
+
+        # same size as the SVG in points
+        svg = render(name, "svg")
+        width = re.search(rb' width="([0-9.]+)mm"', svg).group(1)
+        height = re.search(rb' height="([0-9.]+)mm"', svg).group(1)
+        assert float(page.mediabox.width) == pytest.approx(float(width) * 72 / 25.4, abs=0.1)
+        assert float(page.mediabox.height) == pytest.approx(float(height) * 72 / 25.4, abs=0.1)
+
+    def test_text(self) -> None:
+        pypdf = pytest.importorskip("pypdf")
+        reader = pypdf.PdfReader(io.BytesIO(render("BurnTest", "pdf")), strict=True)
+        assert "burn:0.10mm" in reader.pages[0].extract_text()
+
+
+def toolpath_drawing(fmt: str):
+    """Draw a part with all colors plus a label and return the surface"""
+    surface, ctx = Formats().getSurface(fmt)
+
+    def rect(color, x, y, w, h) -> None:
+        ctx.set_source_rgb(*color)
+        ctx.move_to(x, y)
+        for px, py in ((x + w, y), (x + w, y + h), (x, y + h), (x, y)):
+            ctx.line_to(px, py)
+        ctx.stroke()
+
+    rect(Color.OUTER_CUT, 0, 0, 100, 100)
+    rect(Color.INNER_CUT, 40, 40, 20, 20)
+    rect(Color.ETCHING, 10, 10, 5, 5)
+    rect(Color.ANNOTATIONS, 200, 200, 5, 5)
+    ctx.set_source_rgb(*Color.OUTER_CUT)
+    ctx.move_to(0, 120)
+    ctx.show_text("LABEL")
+    ctx.stroke()
+    surface.set_metadata({
+        "group": "Test", "name": "toolpath", "reproducible": True,
+        "cli": "", "url": "", "creation_date": datetime.datetime.now()})
+    surface.flush()
+    return surface
+
+
+class TestToolpath:
+    """G-code and HPGL cut inner parts first and skip annotations and text."""
+
+    @pytest.mark.parametrize("fmt", ["gcode", "plt"])
+    def test_cut_order(self, fmt) -> None:
+        surface = toolpath_drawing(fmt)
+        surface.finish()
+        paths = surface.toolpaths()
+        priorities = [surface.cut_priority[color] for color, points in paths]
+        assert None not in priorities
+        assert priorities == sorted(priorities)
+        # etching, inner cut, outer cut - the annotation and the label are gone
+        assert [color for color, points in paths] == [2, 1, 0]
+
+    def test_gcode(self) -> None:
+        surface = toolpath_drawing("gcode")
+        data = surface.finish().getvalue().decode()
+        assert "LABEL" not in data
+        assert data.count("M3 ") == 3
+        assert data.rstrip().endswith("M2")
+
+    def test_hpgl(self) -> None:
+        surface = toolpath_drawing("plt")
+        data = surface.finish().getvalue().decode()
+        assert "LABEL" not in data
+        pens = [int(p) for p in re.findall(r"SP(\d+);", data)]
+        assert pens[-1] == 0
+        assert pens[:-1] == sorted(set(pens[:-1]))
+
+    @pytest.mark.parametrize("fmt", ["gcode", "plt"])
+    def test_no_text(self, fmt) -> None:
+        assert b"burn:" not in render("BurnTest", fmt)
@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import argparse
+import sys
+from pathlib import Path
+
+import pytest
+
+try:
+    import boxes
+except ImportError:
+    sys.path.append(Path(__file__).resolve().parent.parent.__str__())
+    import boxes
+
+import boxes.generators
+from boxes import argparseMemorySize
+from boxes.scripts import boxes_main
+
+generators_by_name = {b.__name__: b for b in boxes.generators.getAllBoxGenerators().values()}
+
+
+class TestMemorySize:
+    """Sizes for --max-memory and the other memory limits."""
+
+    @pytest.mark.parametrize("s, size", [
+        ("1000", 1000),
+        ("512K", 512 * 1024),
+        ("512M", 512 * 1024**2),
+        ("2G", 2 * 1024**3),
+        ("2g", 2 * 1024**3),
+        ("1.5M", 1536 * 1024),
+        (" 8M ", 8 * 1024**2),
+        ("0", None),
+        ("none", None),
+        ("", None),
+    ])
+    def test_parse(self, s, size) -> None:
+        assert argparseMemorySize(s) == size
+
+    @pytest.mark.parametrize("s", ["M", "abc", "12T", "1MB", "-1", "-5M", "0.0001", "inf", "nan"])
+    def test_invalid(self, s) -> None:
+        with pytest.raises(argparse.ArgumentTypeError):
+            argparseMemorySize(s)
+
+
+class TestMemoryLimit:
+    """Drawings exceeding max_memory are aborted."""
+
+    @staticmethod
+    def render(compact, max_memory):
+        box = generators_by_name["ABox"]()
+        box.parseArgs([])
+        box.surface_options = {"compact": compact, "max_memory": max_memory}
+        box.metadata["reproducible"] = True
+        box.open()
+        box.render()
+        return box.close().getvalue()
+
+    @pytest.mark.parametrize("compact", [True, False])
+    def test_exceeded(self, compact) -> None:
+        with pytest.raises(ValueError, match="Too many lines"):
+            self.render(compact, 1000)
+
+    @pytest.mark.parametrize("compact", [True, False])
+    def test_within(self, compact) -> None:
+        assert self.render(compact, argparseMemorySize("8M")) == self.render(compact, None)
+
+    def test_cli(self, tmp_path, monkeypatch) -> None:
+        fn = tmp_path / "abox.svg"
+        monkeypatch.setattr(sys, "argv", ["boxes", "--max-memory=1K", "abox", f"--output={fn}"])
+        with pytest.raises(ValueError, match="Too many lines"):
+            boxes_main.main()
+        assert not fn.exists()
+
+        monkeypatch.setattr(sys, "argv", ["boxes", "--max-memory=8M", "abox", f"--output={fn}"])
+        boxes_main.main()
+        assert fn.read_bytes().rstrip().endswith(b"</svg>")
+
+    def test_cli_invalid(self, monkeypatch, capsys) -> None:
+        monkeypatch.setattr(sys, "argv", ["boxes", "--max-memory=-1M", "abox"])
+        with pytest.raises(SystemExit):
+            boxes_main.main()
+        assert "Memory size must be positive" in capsys.readouterr().err
@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+try:
+    import boxes
+except ImportError:
+    sys.path.append(Path(__file__).resolve().parent.parent.__str__())
+    import boxes
+
+from boxes.scripts import boxes_main
+from boxes.scripts.boxes_main import MANIFEST_NAME, load_copies, main, multi_generate
+from boxes.svgmerge import SvgMerge
+
+CONFIG = """
+Defaults:
+  thickness: 3
+Boxes:
+  - box_type: ClosedBox
+    name: closed
+    args:
+      x: 50
+      y: 40
+      h: 30
+  - box_type: ABox
+    name: tray
+    count: 3
+    args:
+      x: 60
+  - box_type: Gears
+    name: gear
+"""
+
+
+@pytest.fixture
+def config(tmp_path):
+    path = tmp_path / "boxes.yml"
+    path.write_text(CONFIG)
+    return path
+
+
+def contents(folder) -> dict[str, bytes]:
+    return {p.name: p.read_bytes() for p in Path(folder).glob("*.svg")}
+
+
+class TestJobs:
+    """Rendering in worker processes gives the same files."""
+
+    def test_parallel(self, config, tmp_path) -> None:
+        serial = tmp_path / "serial"
+        parallel = tmp_path / "parallel"
+        serial.mkdir()
+        parallel.mkdir()
+        files = multi_generate(config, serial, "{name}", jobs=1)
+        parallel_files = multi_generate(config, parallel, "{name}", jobs=2)
+        assert [Path(f).name for f in files] == [Path(f).name for f in parallel_files]
+        assert len(files) == 5
+        assert contents(serial) == contents(parallel)
+
+
+class TestUnchanged:
+    """Boxes are only rendered again if something changed."""
+
+    @staticmethod
+    def states(folder) -> dict[str, int]:
+        return {p.name: p.stat().st_mtime_ns for p in Path(folder).glob("*.svg")}
+
+    def test_second_run(self, config, tmp_path, capsys) -> None:
+        files = multi_generate(config, tmp_path, "{name}")
+        assert (tmp_path / MANIFEST_NAME).exists()
+        before = self.states(tmp_path)
+        capsys.readouterr()
+
+        assert multi_generate(config, tmp_path, "{name}") == files
+        out = capsys.readouterr().out
+        assert "Writing" not in out
+        assert out.count("Unchanged") == 5
+        assert self.states(tmp_path) == before
+
+    def test_force(self, config, tmp_path, capsys) -> None:
+        multi_generate(config, tmp_path, "{name}")
+        capsys.readouterr()
+        multi_generate(config, tmp_path, "{name}", force=True)
+        out = capsys.readouterr().out
+        assert "Unchanged" not in out
+        assert out.count("Writing") == 5
+
+    def test_changed_file(self, config, tmp_path, capsys) -> None:
+        multi_generate(config, tmp_path, "{name}")
+        content = (tmp_path / "closed.svg").read_bytes()
+        (tmp_path / "closed.svg").write_bytes(b"edited")
+        os.remove(tmp_path / "gear.svg")
+        capsys.readouterr()
+        multi_generate(config, tmp_path, "{name}")
+        out = capsys.readouterr().out
+        assert f"Writing {tmp_path / 'closed.svg'}" in out
+        assert f"Writing {tmp_path / 'gear.svg'}" in out
+        assert out.count("Unchanged") == 3
+        assert (tmp_path / "closed.svg").read_bytes() == content
+
+    def test_changed_settings(self, config, tmp_path, capsys) -> None:
+        multi_generate(config, tmp_path, "{name}")
+        config.write_text(CONFIG.replace("x: 60", "x: 61"))
+        capsys.readouterr()
+        multi_generate(config, tmp_path, "{name}")
+        out = capsys.readouterr().out
+        assert out.count("Writing") == 3
+        assert out.count("Unchanged") == 2
+        # other output options write other files
+        multi_generate(config, tmp_path, "{name}", format="dxf")
+        assert "Unchanged" not in capsys.readouterr().out
+
+    def test_other_config(self, config, tmp_path, capsys) -> None:
+        other = tmp_path / "other.yml"
+        other.write_text("""
+Boxes:
+  - box_type: ABox
+    name: other
+""")
+        multi_generate(config, tmp_path, "{name}", copies="count")
+        multi_generate(other, tmp_path, "{name}")
+        capsys.readouterr()
+        # the manifest still knows the boxes of the first configuration
+        files = multi_generate(config, tmp_path, "{name}", copies="count")
+        assert capsys.readouterr().out.count("Unchanged") == 3
+        assert load_copies(files) == {str(tmp_path / "tray.svg"): 3}
+        multi_generate(other, tmp_path, "{name}")
+        assert capsys.readouterr().out.count("Unchanged") == 1
+
+    def test_code_changed(self, config, tmp_path, capsys, monkeypatch) -> None:
+        multi_generate(config, tmp_path, "{name}")
+        capsys.readouterr()
+        # e.g. boxes.edges, which generators use without deriving from it
+        monkeypatch.setattr(boxes_main, "_code_hash", lambda: "changed")
+        multi_generate(config, tmp_path, "{name}")
+        assert "Unchanged" not in capsys.readouterr().out
+
+    def test_code_hash(self, monkeypatch) -> None:
+        # all modules of the package count, not only those of the generator classes
+        paths = []
+        source_hash = boxes_main._source_hash
+        monkeypatch.setattr(boxes_main, "_source_hash", lambda p: paths.append(p) or source_hash(p))
+        boxes_main._code_hash.cache_clear()
+        try:
+            boxes_main._code_hash()
+        finally:
+            boxes_main._code_hash.cache_clear()
+        package = Path(boxes.__file__).parent
+        assert str(package / "edges.py") in paths
+        assert str(package / "lids.py") in paths
+        assert str(package / "generators" / "abox.py") in paths
+
+    def test_cli(self, config, tmp_path, capsys, monkeypatch) -> None:
+        output = tmp_path / "out"
+        output.mkdir()
+        argv = ["boxes", "--multi-generator", str(config), str(output)]
+        monkeypatch.setattr(sys, "argv", argv)
+        main()
+        assert len(list(output.glob("*.svg"))) == 5
+        capsys.readouterr()
+        main()
+        assert capsys.readouterr().out.count("Unchanged") == 5
+        monkeypatch.setattr(sys, "argv", argv + ["--force"])
+        main()
+        assert capsys.readouterr().out.count("Writing") == 5
+
+
+class TestCopies:
+    """Boxes with a count are written as files, hardlinks or once with the count."""
+
+    def test_files(self, config, tmp_path) -> None:
+        files = multi_generate(config, tmp_path, "{name}", copies="files")
+        tray = [tmp_path / f"tray_{i}.svg" for i in range(3)]
+        assert [str(p) for p in tray] == files[1:4]
+        assert len({p.stat().st_ino for p in tray}) == 3
+        assert len({p.read_bytes() for p in tray}) == 1
+        assert load_copies(files) == {}
+
+    @pytest.mark.skipif(not hasattr(os, "link"), reason="needs hardlinks")
+    def test_links(self, config, tmp_path, capsys) -> None:
+        multi_generate(config, tmp_path, "{name}", copies="links")
+        assert capsys.readouterr().out.count("Linking") == 2
+        tray = [tmp_path / f"tray_{i}.svg" for i in range(3)]
+        assert len({p.stat().st_ino for p in tray}) == 1
+        # the links are unchanged files, too
+        multi_generate(config, tmp_path, "{name}", copies="links")
+        assert capsys.readouterr().out.count("Unchanged") == 5
+
+    def test_count(self, config, tmp_path) -> None:
+        files = multi_generate(config, tmp_path, "{name}", copies="count")
+        assert [Path(f).name for f in files] == ["closed.svg", "tray.svg", "gear.svg"]
+        counts = load_copies(files)
+        assert counts == {str(tmp_path / "tray.svg"): 3}
+        # still known for unchanged files
+        assert load_copies(multi_generate(config, tmp_path, "{name}", copies="count")) == counts
+
+        # merged as often as there are copies
+        single = SvgMerge.extract_elements([str(tmp_path / "tray.svg")])
+        elements = SvgMerge.extract_elements([str(tmp_path / "tray.svg")], counts)
+        assert len(elements) == 3 * len(single)
+        assert len({id(e["group"]) for e in elements}) == len(single)
+
+    def test_invalid(self, config, tmp_path) -> None:
+        with pytest.raises(ValueError):
+            multi_generate(config, tmp_path, "{name}", copies="symlinks")
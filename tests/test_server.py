@@ -0,0 +1,469 @@
+from __future__ import annotations
+
+import gzip
+import io
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from pathlib import Path
+from wsgiref.util import setup_testing_defaults
+
+import pytest
+
+try:
+    import boxes
+except ImportError:
+    sys.path.append(Path(__file__).resolve().parent.parent.__str__())
+    import boxes
+
+from boxes.scripts.boxesserver import BServer, PageCache, RenderCache, RenderJobs, accepted_encoding
+
+
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    return BServer(job_dir=str(tmp_path_factory.mktemp("jobs")))
+
+
+def call(server, path, query="", method="GET", body=b"", **environ):
+    """Run a request through BServer.serve
+
+    Returns the status, the headers as dict and the body.
+    """
+    environ.update({
+        "PATH_INFO": path, "QUERY_STRING": query, "REQUEST_METHOD": method,
+        "wsgi.input": io.BytesIO(body), "CONTENT_LENGTH": str(len(body))})
+    setup_testing_defaults(environ)
+    response = {}
+
+    def start_response(status, headers):
+        response["status"] = status
+        response["headers"] = dict(headers)
+
+    data = b"".join(server.serve(environ, start_response))
+    return response["status"], response["headers"], data
+
+
+class TestRenderCache:
+    """Rendered files are kept in memory and on disk."""
+
+    def test_render_twice(self, server) -> None:
+        hits = server.render_cache.hits
+        status, headers, first = call(server, "/ABox", "render=1&x=91")
+        assert status == "200 OK"
+        assert headers["Content-type"].startswith("image/svg+xml")
+        status, headers, second = call(server, "/ABox", "render=1&x=91")
+        assert first == second
+        assert server.render_cache.hits == hits + 1
+
+    def test_memory_limit(self) -> None:
+        cache = RenderCache(max_size=100)
+        cache.put("a", b"x" * 60, [])
+        cache.put("b", b"x" * 60, [])
+        assert cache.get("a") is None
+        assert cache.get("b") == (b"x" * 60, [])
+        assert cache.size == 60
+
+    def test_disk(self, tmp_path) -> None:
+        cache = RenderCache(max_size=1000, directory=str(tmp_path))
+        cache.put("a", b"data", [("Content-type", "text/plain")])
+        # a new process finds the file on disk
+        cache = RenderCache(max_size=1000, directory=str(tmp_path))
+        assert cache.get("a") == (b"data", [("Content-type", "text/plain")])
+
+    def test_disk_limit(self, tmp_path) -> None:
+        cache = RenderCache(max_size=10000, directory=str(tmp_path), max_disk_size=1000)
+        for i, key in enumerate("abcd"):
+            cache.put(key, b"x" * 300, [])
+            # make the order of the modification times certain
+            for fn in (key, key + ".json"):
+                os.utime(tmp_path / fn, (i, i))
+        assert cache.disk_size <= 900
+        assert cache.disk_evictions > 0
+        assert not (tmp_path / "a").exists()
+        assert (tmp_path / "d").exists()
+
+    @staticmethod
+    def directory_size(path) -> int:
+        return sum(p.stat().st_size for p in path.iterdir())
+
+    def test_disk_size(self, tmp_path) -> None:
+        cache = RenderCache(max_size=10000, directory=str(tmp_path), max_disk_size=0)
+        cache.put("a", b"x" * 300, [])
+        assert cache.disk_size == self.directory_size(tmp_path)
+        # replacing a file does not count it twice
+        cache.put("a", b"x" * 100, [("Content-type", "text/plain")])
+        assert cache.disk_size == self.directory_size(tmp_path)
+
+    def test_disk_size_threads(self, tmp_path) -> None:
+        cache = RenderCache(max_size=100000, directory=str(tmp_path), max_disk_size=0)
+
+        def work(n) -> None:
+            for i in range(50):
+                cache.put(f"{(n + i) % 10}", b"x" * (n * 10 + i), [])
+
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert cache.disk_size == self.directory_size(tmp_path)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+class TestPrefork:
+    """--workers serves from forked processes that get replaced."""
+
+    def test_workers(self) -> None:
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        env = dict(os.environ, PYTHONPATH=str(Path(__file__).resolve().parent.parent))
+        process = subprocess.Popen(
+            [sys.executable, "-m", "boxes.scripts.boxesserver", "--host=127.0.0.1", f"--port={port}",
+             "--workers=2", "--max_requests=1"],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            url = f"http://127.0.0.1:{port}"
+            for _ in range(300):
+                try:
+                    urllib.request.urlopen(url + "/admin/ready", timeout=5).close()
+                    break
+                except OSError:
+                    assert process.poll() is None
+                    time.sleep(0.1)
+            # more requests than workers, each worker exits after one
+            for _ in range(5):
+                with urllib.request.urlopen(url + "/ABox?render=1", timeout=30) as f:
+                    assert f.status == 200
+                    assert f.read().startswith(b"<?xml")
+        finally:
+            process.send_signal(signal.SIGTERM)
+            assert process.wait(timeout=30) == 0
+
+
+class TestTimeLimit:
+    """Drawings running out of time end in an error page."""
+
+    @pytest.mark.parametrize("limit", ["max_time", "max_cpu_time"])
+    def test_limit(self, limit) -> None:
+        server = BServer(cache_size=0, **{limit: 1e-9})
+        status, headers, data = call(server, "/ABox", "render=1")
+        assert status == "500 Internal Server Error"
+        assert b"Drawing takes too long" in data
+        # previews show the error as SVG
+        status, headers, data = call(server, "/ABox", "render=4")
+        assert status == "200 OK"
+        assert headers["Content-type"].startswith("image/svg+xml")
+        assert b"Drawing takes too long" in data
+
+
+class TestJobs:
+    """Files rendered in the background with /jobs/."""
+
+    def test_lifecycle(self, server) -> None:
+        status, headers, data = call(server, "/jobs/ABox", "x=81", method="POST")
+        assert status == "202 Accepted"
+        state = json.loads(data)
+        assert state["status"] in ("queued", "running", "done")
+        assert headers["Location"] == "/jobs/" + state["id"]
+
+        status, headers, data = call(server, headers["Location"], "wait=30")
+        assert status == "200 OK"
+        assert json.loads(data)["status"] == "done"
+
+        status, headers, data = call(server, f"/jobs/{state['id']}/file")
+        assert status == "200 OK"
+        assert headers["Content-Disposition"] == 'attachment; filename="ABox.svg"'
+        assert data.startswith(b"<?xml")
+
+    def test_form(self, server) -> None:
+        status, headers, data = call(server, "/jobs/ABox", method="POST", body=b"x=82&format=dxf",
+                                     CONTENT_TYPE="application/x-www-form-urlencoded")
+        assert status == "202 Accepted"
+        job_id = json.loads(data)["id"]
+        assert server.jobs.status(job_id, 30)["status"] == "done"
+        status, headers, data = call(server, f"/jobs/{job_id}/file")
+        assert headers["Content-Disposition"] == 'attachment; filename="ABox.dxf"'
+        assert b"SECTION" in data
+
+    def test_methods(self, server) -> None:
+        status, headers, data = call(server, "/jobs/ABox", "x=83")
+        assert status == "405 Method Not Allowed"
+        assert headers["Allow"] == "POST"
+        status, headers, data = call(server, "/jobs/" + "0" * 32, method="POST")
+        assert status == "405 Method Not Allowed"
+
+    def test_errors(self, server) -> None:
+        status, headers, data = call(server, "/jobs/ABox", "x=abc", method="POST")
+        assert status == "400 Bad Request"
+        status, headers, data = call(server, "/jobs/" + "0" * 32)
+        assert status == "404 Not Found"
+        status, headers, data = call(server, "/jobs/ABox", method="POST", body=b"x" * (65 * 1024),
+                                     CONTENT_TYPE="application/x-www-form-urlencoded")
+        assert status == "413 Content Too Large"
+
+    def test_shared_directory(self, tmp_path) -> None:
+        jobs = RenderJobs(directory=str(tmp_path))
+        job_id = jobs.submit("Test", lambda: (b"data", [("Content-type", "text/plain")]))["id"]
+        assert jobs.status(job_id, 30)["status"] == "done"
+        # another worker process only sees the directory
+        other = RenderJobs(directory=str(tmp_path))
+        assert other.status(job_id)["status"] == "done"
+        assert other.result(job_id) == (b"data", [("Content-type", "text/plain")])
+        jobs.shutdown()
+
+    def test_failed(self) -> None:
+        def fail():
+            raise ValueError("broken")
+
+        jobs = RenderJobs()
+        job_id = jobs.submit("Test", fail)["id"]
+        state = jobs.status(job_id, 30)
+        assert state["status"] == "failed"
+        assert state["error"] == "broken"
+        assert jobs.result(job_id) is None
+        jobs.shutdown()
+
+    def test_expire(self, tmp_path) -> None:
+        jobs = RenderJobs(directory=str(tmp_path))
+        job_id = jobs.submit("Test", lambda: (b"data", []))["id"]
+        assert jobs.status(job_id, 30)["status"] == "done"
+        assert sorted(os.listdir(tmp_path)) == [job_id + ".data", job_id + ".json"]
+        with jobs._cond:
+            jobs._expire()
+        assert jobs.status(job_id) is not None
+
+        # by the time the job finished, not by the file times
+        for fn in os.listdir(tmp_path):
+            os.utime(tmp_path / fn, (0, 0))
+        with jobs._cond:
+            jobs._expire()
+        assert jobs.status(job_id) is not None
+
+        jobs.keep = -1
+        with jobs._cond:
+            jobs._expire()
+        assert jobs.status(job_id) is None
+        assert os.listdir(tmp_path) == []
+        jobs.shutdown()
+
+    def test_too_many(self) -> None:
+        jobs = RenderJobs(workers=1, max_jobs=1)
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait(30)
+            return b"", []
+
+        job_id = jobs.submit("Test", block)["id"]
+        started.wait(30)
+        assert jobs.submit("Test", block) is None
+        release.set()
+        assert jobs.status(job_id, 30)["status"] == "done"
+        assert jobs.submit("Test", lambda: (b"", [])) is not None
+        jobs.shutdown()
+
+
+class TestPrototype:
+    """Instances copied from a prototype render like new ones."""
+
+    @staticmethod
+    def render(box, args) -> bytes:
+        box.parseArgs(args)
+        box.metadata["reproducible"] = True
+        box.open()
+        box.render()
+        return box.close().getvalue()
+
+    @pytest.mark.parametrize("name, args", [
+        ("ABox", ["--x=123", "--FingerJoint_finger=3"]),
+        ("ClosedBox", ["--y=77", "--outside=1"]),
+        ("Gears", ["--teeth1=20", "--modulus=2"]),
+    ])
+    def test_same_output(self, server, name, args) -> None:
+        box_cls = server.boxes[name]
+        assert self.render(box_cls.fromPrototype(), args) == self.render(box_cls(), args)
+        # the arguments of other copies do not leak
+        assert self.render(box_cls.fromPrototype(), []) == self.render(box_cls(), [])
+
+
+class TestETag:
+    """Rendered files can be revalidated with If-None-Match."""
+
+    def test_not_modified(self, server) -> None:
+        status, headers, data = call(server, "/ABox", "render=1&x=92")
+        etag = headers["ETag"]
+        assert headers["Cache-Control"].startswith("public, max-age=")
+        rendered = server.render_cache.misses
+
+        status, headers, data = call(server, "/ABox", "render=1&x=92", HTTP_IF_NONE_MATCH=etag)
+        assert status == "304 Not Modified"
+        assert data == b""
+        assert headers["ETag"] == etag
+        # answered without looking at the cache or rendering
+        assert server.render_cache.misses == rendered
+
+        for if_none_match in (f'W/{etag}', f'"other", {etag}', "*"):
+            status, headers, data = call(server, "/ABox", "render=1&x=92", HTTP_IF_NONE_MATCH=if_none_match)
+            assert status == "304 Not Modified"
+
+    def test_changed(self, server) -> None:
+        status, headers, data = call(server, "/ABox", "render=1&x=93")
+        etag = headers["ETag"]
+        status, headers, data = call(server, "/ABox", "render=1&x=94", HTTP_IF_NONE_MATCH=etag)
+        assert status == "200 OK"
+        assert headers["ETag"] != etag
+        assert data.startswith(b"<?xml")
+
+
+class TestCompression:
+    """Pages and files are compressed if the client accepts it."""
+
+    def test_rendered_file(self, server) -> None:
+        status, headers, plain = call(server, "/ABox", "render=1&x=95")
+        assert "Content-Encoding" not in headers
+        assert headers["Vary"] == "Accept-Encoding"
+        status, headers, data = call(server, "/ABox", "render=1&x=95", HTTP_ACCEPT_ENCODING="gzip, deflate")
+        assert headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(data) == plain
+        # the compressed version has its own tag that still matches
+        etag = headers["ETag"]
+        assert etag.endswith('.gzip"')
+        status, headers, data = call(server, "/ABox", "render=1&x=95", HTTP_ACCEPT_ENCODING="gzip",
+                                     HTTP_IF_NONE_MATCH=etag)
+        assert status == "304 Not Modified"
+
+    def test_page(self, server) -> None:
+        status, headers, plain = call(server, "/ABox")
+        status, headers, data = call(server, "/ABox", HTTP_ACCEPT_ENCODING="gzip")
+        assert headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(data) == plain
+        status, headers, data = call(server, "/", HTTP_ACCEPT_ENCODING="gzip")
+        assert b"<title>Gallery - Boxes.py</title>" in gzip.decompress(data)
+
+    def test_binary(self, server) -> None:
+        status, headers, data = call(server, "/ABox", "render=1&format=pdf", HTTP_ACCEPT_ENCODING="gzip")
+        assert "Content-Encoding" not in headers
+        assert data.startswith(b"%PDF")
+
+    @pytest.mark.parametrize("accept_encoding, encoding", [
+        ("", None),
+        ("gzip", "gzip"),
+        ("GZIP;q=0.5", "gzip"),
+        ("gzip;q=0", None),
+        ("identity", None),
+        ("*", "gzip"),
+        ("*, gzip;q=0", None),
+    ])
+    def test_accepted_encoding(self, accept_encoding, encoding) -> None:
+        assert accepted_encoding(accept_encoding) in ((encoding, "br") if encoding else (None,))
+
+
+class TestPageCache:
+    """Generated pages are kept within a size limit."""
+
+    def test_limit(self) -> None:
+        cache = PageCache(max_size=100)
+        cache.put("a", [b"x" * 40])
+        cache.put("b", [b"x" * 40])
+        assert cache.get("a") == [b"x" * 40]
+        # "b" was used least recently
+        cache.put("c", [b"x" * 40])
+        assert cache.get("b") is None
+        assert cache.get("a") is not None
+        assert cache.size == 80
+        assert cache.evictions == 1
+        # too large for the cache at all
+        cache.put("d", [b"x" * 101])
+        assert cache.get("d") is None
+
+    def test_disabled(self) -> None:
+        cache = PageCache(max_size=0)
+        cache.put("a", [b"x"])
+        assert cache.get("a") is None
+
+    def test_threads(self) -> None:
+        cache = PageCache(max_size=1000)
+
+        def work(n) -> None:
+            for i in range(200):
+                cache.put((n, i % 20), [b"x" * 30])
+                cache.get((n, (i + 7) % 20))
+
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stats = cache.stats()
+        assert stats["size"] == 30 * stats["entries"] <= 1000
+        assert stats["hits"] + stats["misses"] == 8 * 200
+
+    def test_stats(self, server) -> None:
+        call(server, "/ABox")
+        call(server, "/ABox")
+        status, headers, data = call(server, "/admin/cache")
+        assert status == "200 OK"
+        assert headers["Cache-Control"] == "no-store"
+        stats = json.loads(data)
+        assert stats["pages"]["hits"] >= 1
+        assert stats["pages"]["entries"] >= 1
+        assert stats["pages"]["top"]
+        assert stats["files"]["max_size"] == server.render_cache.max_size
+
+
+class TestReady:
+    """/admin/ready fails until warmup() is done."""
+
+    def test_ready(self, server) -> None:
+        status, headers, data = call(server, "/admin/ready")
+        assert status == "200 OK"
+        assert data == b"ready"
+
+    def test_warmup(self, monkeypatch) -> None:
+        server = BServer()
+        monkeypatch.setattr(server, "getLanguages", lambda: [])
+        started = threading.Event()
+        release = threading.Event()
+        genPageGallery = server.genPageGallery
+
+        def blocking_gallery(lang):
+            started.set()
+            release.wait(30)
+            return genPageGallery(lang)
+
+        monkeypatch.setattr(server, "genPageGallery", blocking_gallery)
+        thread = threading.Thread(target=server.warmup)
+        thread.start()
+        try:
+            assert started.wait(30)
+            status, headers, data = call(server, "/admin/ready")
+            assert status == "503 Service Unavailable"
+            assert data == b"warming up"
+        finally:
+            release.set()
+            thread.join()
+        status, headers, data = call(server, "/admin/ready")
+        assert status == "200 OK"
+        # all settings pages are cached, plain and compressed
+        assert server._cache.stats()["entries"] >= 2 * len(server.boxes)
+
+    def test_warmup_fails(self, monkeypatch) -> None:
+        server = BServer()
+
+        def broken(lang):
+            raise RuntimeError("broken")
+
+        monkeypatch.setattr(server, "getLanguages", lambda: [])
+        monkeypatch.setattr(server, "genPageGallery", broken)
+        with pytest.raises(RuntimeError):
+            server.warmup()
+        assert server.ready.is_set()
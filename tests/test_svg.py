@@ -116,6 +116,27 @@ class TestSVG:
         assert referenceData.is_file() is True, "Reference file for comparison does not exist."
         assert referenceData.read_bytes() == boxData.getvalue(), "SVG files are not equal. If change is intended, please update example files."
 
+    @pytest.mark.parametrize(
+        "generator",
+        all_generators.values(),
+        ids=idfunc.__func__,
+    )
+    def test_compact_paths(self, generator: type[boxes.Boxes]) -> None:
+        """Storing paths in arrays must not change the output."""
+        boxName = generator.__name__
+        if boxName in self.avoidGenerator:
+            pytest.skip("Skipped generator")
+        box = generator()
+        box.surface_options = {"compact": True}
+        box.parseArgs("")
+        box.metadata["reproducible"] = True
+        box.open()
+        box.render()
+        boxData = box.close()
+
+        referenceData = Path(__file__).resolve().parent.parent / 'examples' / (boxName + '.svg')
+        assert referenceData.read_bytes() == boxData.getvalue(), "SVG output differs when using compact paths."
+
     if additionalTests:
         @pytest.mark.parametrize(
             "generator_idx",
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import io
+import sys
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import pytest
+from svgpathtools import parse_path
+
+try:
+    import boxes
+except ImportError:
+    sys.path.append(Path(__file__).resolve().parent.parent.__str__())
+    import boxes
+
+import boxes.generators
+from boxes.svgmerge import SvgMerge, curve_extrema, simple_path_points
+
+generators_by_name = {b.__name__: b for b in boxes.generators.getAllBoxGenerators().values()}
+examples = sorted((Path(__file__).parent.parent / "examples").glob("*.svg"))
+
+
+def signature(group):
+    return [(e.tag, sorted(e.attrib.items()), (e.text or "").strip()) for e in group.iter()]
+
+
+class TestPartGroups:
+    """SVGSurface.part_groups() gives the same groups as parsing the SVG."""
+
+    @pytest.mark.parametrize("name", [
+        "ClosedBox", "Rack10Box", "Gears", "FlexBox", "BurnTest",
+        # with curves bulging beyond their end points
+        "Spool", "FilamentSpool", "Clock", "Planetary", "TrafficLight", "LaserHoldfast"])
+    def test_groups(self, name) -> None:
+        box = generators_by_name[name]()
+        box.parseArgs([])
+        box.metadata["reproducible"] = True
+        box.open()
+        box.render()
+        data = box.close().getvalue()
+
+        rendered = SvgMerge.group_elements(box.surface.part_groups(), name)
+        parsed = SvgMerge.extract_elements([io.BytesIO(data)])
+        assert len(rendered) == len(parsed)
+        for r, p in zip(rendered, parsed):
+            assert signature(r["group"]) == signature(p["group"])
+            if r["group"].find(".//{http://www.w3.org/2000/svg}text") is None:
+                assert r["bbox"] == pytest.approx(p["bbox"], abs=0.01)
+                # the SVG is written with three decimals
+                paths = [e.get("d") for e in r["group"].iter() if e.tag.endswith("}path")]
+                assert r["bbox"] == pytest.approx(reference_bbox(paths), abs=0.001)
+            else:
+                # the parser does not know the size of text
+                assert r["bbox"][0] <= p["bbox"][0] + 0.01
+                assert r["bbox"][1] <= p["bbox"][1] + 0.01
+                assert r["bbox"][2] >= p["bbox"][2] - 0.01
+                assert r["bbox"][3] >= p["bbox"][3] - 0.01
+
+
+def reference_bbox(paths):
+    """Bounding box of path data with svgpathtools as [min_x, min_y, max_x, max_y]"""
+    bboxes = [parse_path(d).bbox() for d in paths]
+    return [min(b[0] for b in bboxes), min(b[2] for b in bboxes),
+            max(b[1] for b in bboxes), max(b[3] for b in bboxes)]
+
+
+def path_group(d):
+    g = ET.Element("g")
+    ET.SubElement(g, "path", d=d)
+    return g
+
+
+class TestBBox:
+    """Bounding boxes of paths written by SVGSurface are read without svgpathtools."""
+
+    @pytest.mark.parametrize("fn", examples, ids=[fn.name for fn in examples])
+    def test_examples(self, fn) -> None:
+        groups, tree = SvgMerge.parse_svg_groups(fn)
+        for group in groups:
+            paths = [e.get("d", "") for e in group.iter() if e.tag.endswith("}path")]
+            if not paths:
+                continue
+            # the fast path is used for all of them
+            assert all(simple_path_points(d) is not None for d in paths)
+            assert SvgMerge.get_bbox_of_group(group) == pytest.approx(reference_bbox(paths), abs=1e-6)
+
+    @pytest.mark.parametrize("d", [
+        "M 0 0 C 0 10 10 10 10 0",
+        "M 0 0 C 10 -5 -5 10 10 10 C 20 15 5 -20 0 0 Z",
+        "M 1e1 2E-1 L -.5 .5 H 3 V -4",
+        "M 0 0 10 10 20 0",
+        "M 0 0 H 10 V 10 Z M 20 20 L 30 30",
+    ])
+    def test_simple(self, d) -> None:
+        xs, ys, curves = simple_path_points(d)
+        x, y = curve_extrema(curves, min(xs), max(xs), min(ys), max(ys))
+        bbox = [min(xs + x), min(ys + y), max(xs + x), max(ys + y)]
+        assert bbox == pytest.approx(reference_bbox([d]), abs=1e-9)
+        assert SvgMerge.get_bbox_of_group(path_group(d)) == pytest.approx(bbox, abs=1e-9)
+
+    @pytest.mark.parametrize("d", [
+        "m 10 10 l 5 5 z",
+        "M0,0 Q 10,10 20,0",
+        "M 0 0 A 5 5 0 0 1 10 0",
+        "M0 0C0 10 10 10 10 0S20 -10 20 0",
+    ])
+    def test_other(self, d) -> None:
+        # left to svgpathtools
+        assert simple_path_points(d) is None
+        assert SvgMerge.get_bbox_of_group(path_group(d)) == pytest.approx(reference_bbox([d]), abs=1e-9)
+
+    def test_empty(self) -> None:
+        with pytest.raises(ValueError):
+            SvgMerge.get_bbox_of_group(ET.Element("g"))